@@ -1,16 +1,32 @@
-from flask import Flask, render_template, request, send_file, redirect, url_for, jsonify
-from PyPDF2 import PdfMerger, PdfReader, PdfWriter
+from flask import Flask, render_template, request, send_file, redirect, url_for, jsonify, Response, stream_with_context, g, has_request_context
 import os
 import uuid
 from werkzeug.utils import secure_filename
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
 import io
-from PIL import Image
-import fitz  # PyMuPDF
+import base64
+import hashlib
+import sqlite3
+import sys
 import json
-import warnings
+import multiprocessing
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from contextlib import contextmanager, closing
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+# PyPDF2, PyMuPDF (fitz) and Pillow are imported where they are used, so a cold
+# start serving a template-only route never loads them; see warm_up()
 
-# Suppress PyPDF2 warnings about malformed PDFs
-warnings.filterwarnings("ignore", category=UserWarning, module="PyPDF2")
+# The merge/edit core is shared with the batch CLI; make it importable however app.py is loaded
+if os.path.dirname(os.path.abspath(__file__)) not in sys.path:
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+from pdf_core import (  # noqa: E402
+    use_config, metrics, timed, count_output, peak_rss_bytes, phase_listeners, document_pool,
+    merge_files, optimize_pdf, OPTIMIZE_LEVELS, apply_page_edits, plan_split, split_pdf, load_pdf_libraries,
+    image_format, convert_images
+)
 
 app = Flask(__name__, template_folder='../templates', static_folder='../static')
 app.config['UPLOAD_FOLDER'] = '/tmp/uploads'
@@ -20,36 +36,714 @@ app.config['EDIT_FOLDER'] = '/tmp/edit_sessions'
 # Using chunked upload approach to handle larger files
 app.config['MAX_CONTENT_LENGTH'] = 50 * 1024 * 1024  # 50MB for chunked uploads
 app.config['CHUNK_SIZE'] = 4 * 1024 * 1024  # 4MB chunks (under 4.5MB limit)
+# Largest file a chunked upload may declare, and the smallest chunks it may be split into
+app.config['UPLOAD_MAX_FILE_SIZE'] = 50 * 1024 * 1024  # Same per-file limit as direct uploads
+app.config['UPLOAD_MIN_CHUNK_SIZE'] = 64 * 1024
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 0  # Disable caching for development
+# Page thumbnails are cached inside each edit session directory
+app.config['THUMBNAIL_SCALE'] = 0.8
+app.config['THUMBNAIL_QUALITY'] = 60
+# Extra (zoom, quality) tiers selectable with ?tier=; 'standard' is the scale/quality above
+app.config['THUMBNAIL_TIERS'] = {
+    'low': (0.4, 40),
+    'high': (1.6, 75),
+}
+app.config['THUMBNAIL_PRERENDER_TIER'] = 'low'  # What the editor requests first
+app.config['PREVIEW_MAX_AGE'] = 365 * 24 * 3600  # Previews are immutable for a given ETag
+app.config['THUMBNAIL_CACHE_MAX_BYTES'] = 256 * 1024 * 1024  # Shared by all sessions, per server process
+app.config['THUMBNAIL_PRERENDER_WORKERS'] = 2
+app.config['THUMBNAIL_PRERENDER_PAGES'] = 500  # Per session, starting from page 1
+app.config['THUMBNAIL_BATCH_MAX_PAGES'] = 50  # Largest range served by /page-images
+# Default output optimization level (0-3) when a request doesn't send one
+app.config['DEFAULT_OPTIMIZE_LEVEL'] = 0
+# Finalized chunked uploads are indexed by fileId and expire if never used
+app.config['UPLOAD_REGISTRY_PATH'] = os.path.join(app.config['UPLOAD_FOLDER'], 'registry.sqlite3')
+app.config['UPLOAD_TTL'] = 60 * 60  # Seconds
+# Uploaded PDFs are stored once per distinct content, named by BLAKE2 digest;
+# unreferenced blobs are kept for UPLOAD_TTL so repeat uploads can reuse them
+app.config['BLOB_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], 'blobs')
+# Background merge/edit jobs run in worker processes; serverless platforms freeze
+# work after the response is sent, so the pages fall back to synchronous routes there
+app.config['JOBS_FOLDER'] = '/tmp/jobs'
+app.config['ASYNC_JOBS'] = not os.environ.get('VERCEL')
+app.config['JOB_WORKERS'] = min(4, os.cpu_count() or 1)
+app.config['JOB_QUEUE_LIMIT'] = 16  # Queued plus running jobs before returning 503
+app.config['JOB_RETRY_AFTER'] = 5  # Seconds, sent with 503 responses
+app.config['JOB_STATUS_TTL'] = 60 * 60  # Seconds to keep finished job status files
+# Split parts are extracted in their own worker processes (0 extracts them in the request thread)
+app.config['SPLIT_WORKERS'] = 0 if os.environ.get('VERCEL') else (os.cpu_count() or 1)
+# Merges and page edits within these limits run in the browser with pdf-lib (0 bytes turns
+# this off); the bundled static/js/pdf-lib.min.js is tried first, then CLIENT_PDF_LIB_URL
+app.config['CLIENT_PDF_MAX_BYTES'] = 20 * 1024 * 1024
+app.config['CLIENT_PDF_MAX_PAGES'] = 500
+app.config['CLIENT_PDF_LIB_URL'] = os.environ.get(
+    'CLIENT_PDF_LIB_URL', 'https://cdn.jsdelivr.net/npm/pdf-lib@1.17.1/dist/pdf-lib.min.js')
+# Downloaded outputs stay available this long after their last download, so
+# interrupted downloads can resume; merged files never downloaded expire after OUTPUT_TTL
+app.config['DOWNLOAD_RETENTION'] = 15 * 60  # Seconds
+app.config['OUTPUT_TTL'] = 60 * 60  # Seconds
+# Expired outputs are also purged when new work arrives, at most this often
+app.config['PURGE_INTERVAL'] = 60  # Seconds
+# Let a fronting server (nginx X-Accel-Redirect / Apache mod_xsendfile) send outputs
+app.config['USE_X_SENDFILE'] = bool(os.environ.get('USE_X_SENDFILE'))
+# Load the PDF libraries in a background thread at startup instead of on the first PDF request
+app.config['WARM_UP'] = bool(os.environ.get('WARM_UP'))
+# Print one JSON line per request with its phase timings
+app.config['TIMING_LOG'] = bool(os.environ.get('TIMING_LOG'))
+# Merge engine, document pool and METRICS_ENABLED settings are defined in pdf_core.config
+use_config(app.config)
 
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+os.makedirs(app.config['BLOB_FOLDER'], exist_ok=True)
 os.makedirs(app.config['MERGED_FOLDER'], exist_ok=True)
 os.makedirs(app.config['EDIT_FOLDER'], exist_ok=True)
+os.makedirs(app.config['JOBS_FOLDER'], exist_ok=True)
+
+
+# INSTRUMENTATION
+
+def record_request_phase(phase, seconds):
+    if has_request_context():
+        g.setdefault('phase_timings', []).append((phase, round(seconds, 6)))
+
+
+phase_listeners.append(record_request_phase)
+
+
+@app.before_request
+def start_request_timer():
+    if app.config['METRICS_ENABLED']:
+        g.request_start = time.perf_counter()
+
+
+@app.after_request
+def record_request_metrics(response):
+    start = g.get('request_start')
+    if start is None:
+        return response
+    endpoint = request.endpoint or 'unmatched'
+    method = request.method
+    bytes_in = request.content_length or 0
+    phases = g.setdefault('phase_timings', [])
+    sent = {'bytes': response.content_length}
+    
+    if sent['bytes'] is None and response.is_streamed and not response.direct_passthrough:
+        # Count streamed bodies (NDJSON, SSE) as they are sent
+        sent['bytes'] = 0
+        body = response.response
+        
+        def counted():
+            for chunk in body:
+                sent['bytes'] += len(chunk)
+                yield chunk
+        response.response = counted()
+    
+    def record():
+        duration = time.perf_counter() - start
+        metrics.observe('pdf_http_request_duration_seconds', duration,
+                        endpoint=endpoint, method=method, status=response.status_code)
+        metrics.inc('pdf_http_request_bytes_total', bytes_in, endpoint=endpoint)
+        metrics.inc('pdf_http_response_bytes_total', sent['bytes'] or 0, endpoint=endpoint)
+        if app.config['TIMING_LOG']:
+            print(json.dumps({
+                'event': 'request',
+                'endpoint': endpoint,
+                'method': method,
+                'status': response.status_code,
+                'duration': round(duration, 6),
+                'bytes_in': bytes_in,
+                'bytes_out': sent['bytes'] or 0,
+                'phases': phases,
+                'peak_rss_bytes': peak_rss_bytes()
+            }), flush=True)
+    
+    if response.direct_passthrough:
+        # File responses go straight to the server's file wrapper and never run
+        # close hooks, so they are recorded when handed over
+        record()
+    else:
+        # Runs once the body has been sent, so streamed responses are timed in full
+        response.call_on_close(record)
+    return response
+
+
+# EDIT SESSION MANIFEST
+
+def _manifest_path(session_dir):
+    return os.path.join(session_dir, 'manifest.json')
+
+
+def write_session_manifest(session_dir, doc, content_hash):
+    """Describe an edit session's PDF in one pass and save it as manifest.json.
+
+    The manifest records the page count, each page's media box and rotation,
+    the content hash and basic structure info, so the editor, the thumbnail
+    renderer and the edit engine never reopen the PDF just to learn them.
+    """
+    manifest = {
+        'content_hash': content_hash,
+        'size': os.path.getsize(os.path.join(session_dir, 'original.pdf')),
+        'page_count': len(doc),
+        'pages': [{'mediabox': [round(v, 2) for v in page.mediabox], 'rotation': page.rotation} for page in doc],
+        'structure': {
+            'format': (doc.metadata or {}).get('format'),
+            'encrypted': doc.is_encrypted,
+            'repaired': doc.is_repaired,
+            'outline_entries': len(doc.get_toc()),
+            'form_fields': int(doc.is_form_pdf or 0)
+        }
+    }
+    path = _manifest_path(session_dir)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f)
+    os.replace(tmp_path, path)
+    return manifest
+
+
+@lru_cache(maxsize=256)
+def _read_manifest(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def load_session_manifest(session_id):
+    """Return an edit session's manifest, or None if the session doesn't exist.
+
+    Sessions created before manifests existed get one on first use.
+    """
+    session_dir = os.path.join(app.config['EDIT_FOLDER'], session_id)
+    # The stat keeps the parsed-manifest cache from outliving a deleted session
+    if os.path.exists(_manifest_path(session_dir)):
+        return _read_manifest(_manifest_path(session_dir))
+    pdf_path = os.path.join(session_dir, 'original.pdf')
+    if not os.path.exists(pdf_path):
+        return None
+    checksum = hashlib.blake2b()
+    with open(pdf_path, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            checksum.update(block)
+    digest = checksum.hexdigest()
+    with document_pool.borrow(blob_store.path(digest), pdf_path) as doc:
+        return write_session_manifest(session_dir, doc, digest)
+
+
+def borrow_session_document(session_id, manifest):
+    """Borrow the open document of an edit session from the pool.
+
+    Handles are keyed by content, so the one opened while building the
+    manifest, or by a merge of the same upload, is reused.
+    """
+    pdf_path = os.path.join(app.config['EDIT_FOLDER'], session_id, 'original.pdf')
+    return document_pool.borrow(blob_store.path(manifest['content_hash']), pdf_path)
+
+
+def page_aspect_ratios(manifest):
+    """Width / height of each page as displayed, i.e. after rotation"""
+    ratios = []
+    for page in manifest['pages']:
+        x0, y0, x1, y1 = page['mediabox']
+        width, height = abs(x1 - x0), abs(y1 - y0)
+        if page['rotation'] % 180:
+            width, height = height, width
+        ratios.append(round(width / height, 4) if height else 1)
+    return ratios
+
+
+# PAGE THUMBNAIL CACHE
+
+# Preview output format -> (MIME type, file extension)
+PREVIEW_FORMATS = {
+    'jpeg': ('image/jpeg', 'jpg'),
+    'webp': ('image/webp', 'webp'),
+}
+
+class ThumbnailCache:
+    """Size-bounded LRU index over the thumbnails stored in session directories.
+
+    Rendered images live in ``<session_dir>/thumbs/page_<n>_<tier>.<ext>``;
+    this index only tracks their sizes so the least recently used ones can be
+    evicted once the total across all sessions exceeds ``max_bytes``.
+
+    The index is rebuilt from the thumbnails already under ``root`` (oldest
+    first) the first time this process stores one, so files left by earlier
+    runs count towards the budget. Each server process still keeps its own
+    index and only sees files others wrote as of that scan or when it reads
+    them, so with several processes the bound is per process and best-effort.
+    """
+
+    def __init__(self, max_bytes, root=None):
+        self.max_bytes = max_bytes
+        self.root = root
+        self._entries = OrderedDict()  # path -> size in bytes
+        self._total = 0
+        self._scanned = root is None
+        self._lock = threading.Lock()
+
+    def total_bytes(self):
+        with self._lock:
+            return self._total
+
+    @staticmethod
+    def path_for(session_dir, page_num, tier='standard', fmt='jpeg'):
+        return os.path.join(session_dir, 'thumbs', f'page_{page_num}_{tier}.{PREVIEW_FORMATS[fmt][1]}')
+
+    def get(self, session_dir, page_num, tier='standard', fmt='jpeg'):
+        """Return the cached thumbnail path, or None on a miss."""
+        path = self.path_for(session_dir, page_num, tier, fmt)
+        with self._lock:
+            if path in self._entries:
+                self._entries.move_to_end(path)
+                if os.path.exists(path):
+                    return path
+                self._total -= self._entries.pop(path)
+                return None
+        # Files written before a restart are picked up lazily
+        if os.path.exists(path):
+            self._track(path, os.path.getsize(path))
+            return path
+        return None
+
+    def put(self, session_dir, page_num, img_data, tier='standard', fmt='jpeg'):
+        """Store a rendered thumbnail and return its path."""
+        path = self.path_for(session_dir, page_num, tier, fmt)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # Write to a temp file first so concurrent readers never see a partial image
+        tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(tmp_path, 'wb') as f:
+            f.write(img_data)
+        os.replace(tmp_path, path)
+        self._track(path, len(img_data))
+        return path
+
+    def forget_session(self, session_dir):
+        """Drop index entries for a session whose directory is being removed."""
+        prefix = os.path.join(session_dir, 'thumbs') + os.sep
+        with self._lock:
+            for path in [p for p in self._entries if p.startswith(prefix)]:
+                self._total -= self._entries.pop(path)
+
+    def _scan_existing(self):
+        found = []
+        try:
+            sessions = list(os.scandir(self.root))
+        except OSError:
+            sessions = []
+        for session in sessions:
+            try:
+                for entry in os.scandir(os.path.join(session.path, 'thumbs')):
+                    if entry.name.startswith('page_') and not entry.name.endswith('.tmp'):
+                        stat = entry.stat()
+                        found.append((stat.st_mtime, entry.path, stat.st_size))
+            except OSError:
+                pass  # Not a session, or removed meanwhile
+        found.sort()
+        with self._lock:
+            # Thumbnails this process already tracks are the most recently used
+            entries = OrderedDict((path, size) for _, path, size in found if path not in self._entries)
+            entries.update(self._entries)
+            self._entries = entries
+            self._total = sum(entries.values())
+
+    def _track(self, path, size):
+        if not self._scanned:
+            self._scanned = True
+            self._scan_existing()
+        evicted = []
+        with self._lock:
+            if path in self._entries:
+                self._total -= self._entries.pop(path)
+            self._entries[path] = size
+            self._total += size
+            while self._total > self.max_bytes and len(self._entries) > 1:
+                old_path, old_size = self._entries.popitem(last=False)
+                self._total -= old_size
+                evicted.append(old_path)
+        for old_path in evicted:
+            try:
+                os.remove(old_path)
+            except OSError:
+                pass
+
+
+thumbnail_cache = ThumbnailCache(app.config['THUMBNAIL_CACHE_MAX_BYTES'], app.config['EDIT_FOLDER'])
+prerender_executor = ThreadPoolExecutor(
+    max_workers=app.config['THUMBNAIL_PRERENDER_WORKERS'],
+    thread_name_prefix='thumb-prerender'
+)
+
+
+def thumbnail_params(tier):
+    """Return the (zoom, quality) of a preview tier; raises KeyError if unknown"""
+    if tier == 'standard':
+        return app.config['THUMBNAIL_SCALE'], app.config['THUMBNAIL_QUALITY']
+    return app.config['THUMBNAIL_TIERS'][tier]
+
+
+@lru_cache(maxsize=None)
+def webp_supported():
+    from PIL import features
+    return features.check('webp')
+
+
+def render_page_thumbnail(doc, page_num, tier='standard', fmt='jpeg'):
+    """Render a 1-based page of an open fitz document to image bytes"""
+    import fitz  # PyMuPDF
+    page = doc[page_num - 1]  # PyMuPDF uses 0-based indexing
+    scale, quality = thumbnail_params(tier)
+    # Lower resolution and image quality keep generation fast for large files
+    with timed('render'):
+        pix = page.get_pixmap(matrix=fitz.Matrix(scale, scale), alpha=False)
+    with timed('encode'):
+        if fmt == 'webp':
+            from PIL import Image
+            buffer = io.BytesIO()
+            Image.frombytes('RGB', (pix.width, pix.height), pix.samples).save(buffer, 'WEBP', quality=quality)
+            img_data = buffer.getvalue()
+        else:
+            img_data = pix.tobytes("jpeg", jpg_quality=quality)
+    count_output('render', 1)
+    return img_data
+
+
+def load_page_thumbnail(session_id, page_num, tier='standard', fmt='jpeg'):
+    """Return image bytes for a page, rendering and caching it on a miss"""
+    session_dir = os.path.join(app.config['EDIT_FOLDER'], session_id)
+    cached_path = thumbnail_cache.get(session_dir, page_num, tier, fmt)
+    if cached_path:
+        try:
+            with open(cached_path, 'rb') as f:
+                return f.read()
+        except FileNotFoundError:
+            pass  # Evicted between lookup and read; render it again
+    with borrow_session_document(session_id, load_session_manifest(session_id)) as doc:
+        img_data = render_page_thumbnail(doc, page_num, tier, fmt)
+    thumbnail_cache.put(session_dir, page_num, img_data, tier, fmt)
+    return img_data
+
+
+def prerender_thumbnails(session_id):
+    """Render thumbnails for a session in page order, skipping cached pages"""
+    session_dir = os.path.join(app.config['EDIT_FOLDER'], session_id)
+    tier = app.config['THUMBNAIL_PRERENDER_TIER']
+    try:
+        manifest = load_session_manifest(session_id)
+        last_page = min(manifest['page_count'], app.config['THUMBNAIL_PRERENDER_PAGES'])
+        for page_num in range(1, last_page + 1):
+            # Stop once the session has been downloaded and cleaned up
+            if not os.path.exists(session_dir):
+                return
+            if thumbnail_cache.get(session_dir, page_num, tier):
+                continue
+            # Borrow per page so interactive requests can interleave
+            with borrow_session_document(session_id, manifest) as doc:
+                img_data = render_page_thumbnail(doc, page_num, tier)
+            thumbnail_cache.put(session_dir, page_num, img_data, tier)
+    except Exception as e:
+        print(f"Error pre-rendering thumbnails for session {session_id}: {e}")
+
+
+@lru_cache(maxsize=None)
+def renderer_version():
+    # Read from the package metadata so a 304 doesn't have to load PyMuPDF
+    from importlib.metadata import version
+    return version('PyMuPDF')
+
+
+def preview_etag(manifest, pages, tier, fmt):
+    """Strong ETag for previews of ``pages`` (a page number or range string).
+
+    It covers everything that determines the image bytes: the PDF content,
+    the pages, the render parameters and the renderer version.
+    """
+    scale, quality = thumbnail_params(tier)
+    key = f"{manifest['content_hash']}:{pages}:{scale}:{quality}:{fmt}:{renderer_version()}"
+    return hashlib.blake2b(key.encode(), digest_size=16).hexdigest()
+
+
+def cache_preview(response, etag, use_accept=True):
+    """Mark a preview response as immutable and validated by ``etag``"""
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = f"private, max-age={app.config['PREVIEW_MAX_AGE']}, immutable"
+    if use_accept:
+        response.vary.add('Accept')
+    return response
+
+
+def preview_request_options(use_accept=True):
+    """Read the preview tier and format from the query string and Accept header.
+
+    Returns ``(tier, fmt)``, or None if the tier is unknown. WebP is used when
+    asked for with ?format=webp or, if ``use_accept``, when the client lists
+    image/webp in its Accept header, provided Pillow was built with WebP
+    support.
+    """
+    tier = request.args.get('tier', 'standard')
+    if tier != 'standard' and tier not in app.config['THUMBNAIL_TIERS']:
+        return None
+    fmt = request.args.get('format', None if use_accept else 'jpeg')
+    if fmt is None:
+        accepted = {mimetype for mimetype, quality in request.accept_mimetypes if quality > 0}
+        fmt = 'webp' if 'image/webp' in accepted else 'jpeg'
+    if fmt not in PREVIEW_FORMATS or (fmt == 'webp' and not webp_supported()):
+        fmt = 'jpeg'
+    return tier, fmt
+
+
+def schedule_prerender(session_id):
+    """Queue background thumbnail rendering for a new edit session"""
+    prerender_executor.submit(prerender_thumbnails, session_id)
+
+def _requested_optimize_level():
+    """Read the optional ``optimize`` form field (0-3)"""
+    level = request.form.get('optimize', app.config['DEFAULT_OPTIMIZE_LEVEL'], type=int)
+    return max(0, min(level or 0, max(OPTIMIZE_LEVELS)))
+
+
+def _requested_image_dpi():
+    """Read the optional ``image_dpi`` form field (0 keeps images at full resolution)"""
+    dpi = request.form.get('image_dpi', app.config['IMAGE_TARGET_DPI'], type=int)
+    return max(0, dpi or 0)
+
+
+def client_pdf_settings(**extra):
+    """Limits and script URLs for merges and edits done in the browser (static/js/client-pdf.js)"""
+    lib_urls = [url_for('static', filename='js/pdf-lib.min.js'), app.config['CLIENT_PDF_LIB_URL']]
+    return dict({
+        'maxBytes': app.config['CLIENT_PDF_MAX_BYTES'],
+        'maxPages': app.config['CLIENT_PDF_MAX_PAGES'],
+        'workerUrl': url_for('static', filename='js/pdf-worker.js'),
+        'libUrls': [url for url in lib_urls if url],
+    }, **extra)
+
+
+# DOWNLOADS
+
+def _download_marker(output_path):
+    return f"{output_path}.downloaded"
+
+
+class _ClosingFile(io.FileIO):
+    """Read-only file that runs ``on_close`` once the server has sent and closed it"""
+
+    def __init__(self, path, on_close):
+        super().__init__(path, 'rb')
+        self._on_close = on_close
+
+    def close(self):
+        if not self.closed:
+            super().close()
+            self._on_close()
+
+
+def send_output(output_path, download_name):
+    """Send a finished PDF and start its retention window once the body is sent.
+
+    The file goes to the server's ``wsgi.file_wrapper``, which gunicorn and
+    uWSGI send with sendfile(), and Range/If-Range requests get 206 partial
+    content, so downloads can resume or be fetched in parallel. Nothing is
+    deleted here; ``purge_expired_outputs`` does that later.
+    """
+    def mark_downloaded():
+        try:
+            with open(_download_marker(output_path), 'a'):
+                pass
+            os.utime(_download_marker(output_path))
+        except OSError:
+            pass  # Already purged
+        try:
+            purge_expired_outputs()
+        except Exception as e:
+            print(f"Error purging expired outputs: {e}")
+    
+    if app.config['USE_X_SENDFILE']:
+        # The fronting server reads the file itself, after this response
+        mark_downloaded()
+        return send_file(output_path, mimetype='application/pdf', as_attachment=True,
+                         download_name=download_name, conditional=True)
+    
+    # send_file can't see the path of a file object, so validators and ranges are set up here.
+    # Response.call_on_close never fires for file responses; the file's own close() does.
+    stat = os.stat(output_path)
+    file = _ClosingFile(output_path, mark_downloaded)
+    response = send_file(file, mimetype='application/pdf', as_attachment=True,
+                         download_name=download_name, conditional=False, etag=False)
+    response.content_length = stat.st_size
+    response.last_modified = stat.st_mtime
+    response.set_etag(f"{stat.st_mtime_ns:x}-{stat.st_size:x}")
+    try:
+        response = response.make_conditional(request.environ, accept_ranges=True, complete_length=stat.st_size)
+    except RequestedRangeNotSatisfiable:
+        file.close()
+        return Response(status=416, headers={'Content-Range': f'bytes */{stat.st_size}'})
+    if response.status_code == 304:
+        file.close()
+    return response
+
+
+class _ZipBuffer(io.RawIOBase):
+    """Write-only, unseekable sink that collects what zipfile writes until it is taken"""
+
+    def __init__(self):
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def take(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+def stream_zip(entries, chunk_size=1024 * 1024):
+    """Yield a ZIP archive of ``(archive_name, path)`` entries while it is being built.
+
+    zipfile writes data descriptors after each entry when its output can't
+    seek, so nothing is buffered beyond one chunk. PDFs are already
+    compressed and are stored as-is. Each file is deleted once it is added.
+    """
+    import zipfile
+    sink = _ZipBuffer()
+    with zipfile.ZipFile(sink, 'w', compression=zipfile.ZIP_STORED) as archive:
+        for name, path in entries:
+            info = zipfile.ZipInfo(name, date_time=time.localtime()[:6])
+            info.file_size = os.path.getsize(path)  # Lets zipfile decide on ZIP64 up front
+            with open(path, 'rb') as src, archive.open(info, 'w') as dest:
+                for block in iter(lambda: src.read(chunk_size), b''):
+                    dest.write(block)
+                    yield sink.take()
+            os.remove(path)
+            yield sink.take()
+    yield sink.take()
+
+
+def _output_expired(output_path, now):
+    """True once an output's retention window or, if never downloaded, its TTL has passed"""
+    try:
+        return os.path.getmtime(_download_marker(output_path)) < now - app.config['DOWNLOAD_RETENTION']
+    except FileNotFoundError:
+        pass
+    try:
+        return os.path.getmtime(output_path) < now - app.config['OUTPUT_TTL']
+    except FileNotFoundError:
+        return True
+
+
+def _session_pool_keys(session_dir):
+    """Document pool keys of a session's PDF and of its attached insert files"""
+    keys = set()
+    try:
+        keys.add(blob_store.path(_read_manifest(_manifest_path(session_dir))['content_hash']))
+    except (OSError, ValueError, KeyError):
+        pass  # No manifest: the session's PDF was never opened through the pool
+    inserts_dir = os.path.join(session_dir, 'inserts')
+    if os.path.isdir(inserts_dir):
+        for name in os.listdir(inserts_dir):
+            if name.endswith('.json'):
+                try:
+                    keys.add(_read_manifest(os.path.join(inserts_dir, name))['key'])
+                except (OSError, ValueError, KeyError):
+                    pass
+    return keys
+
+
+def purge_expired_outputs():
+    """Delete merged files and downloaded edit sessions whose windows have passed.
+
+    Pooled documents of a removed session are closed as well, unless a
+    session that remains uses the same content: a handle opened from the
+    session's own files would otherwise keep them open after removal.
+    """
+    import shutil
+    now = time.time()
+    with timed('cleanup'):
+        for entry in os.scandir(app.config['MERGED_FOLDER']):
+            if entry.name.endswith('.pdf') and _output_expired(entry.path, now):
+                for path in (entry.path, _download_marker(entry.path)):
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+        # Sessions are only removed after a download; one still being edited has no marker
+        removed_keys, kept_sessions = set(), []
+        for entry in os.scandir(app.config['EDIT_FOLDER']):
+            if not entry.is_dir():
+                continue
+            output_path = os.path.join(entry.path, 'edited.pdf')
+            if os.path.exists(_download_marker(output_path)) and _output_expired(output_path, now):
+                removed_keys |= _session_pool_keys(entry.path)
+                thumbnail_cache.forget_session(entry.path)
+                shutil.rmtree(entry.path, ignore_errors=True)
+            else:
+                kept_sessions.append(entry.path)
+        if removed_keys:
+            for session_dir in kept_sessions:
+                removed_keys -= _session_pool_keys(session_dir)
+            for key in removed_keys:
+                document_pool.discard(key)
+
+
+_last_purge = 0.0
+_purge_lock = threading.Lock()
+
+
+def purge_expired_outputs_soon():
+    """Run ``purge_expired_outputs`` if it hasn't run for ``PURGE_INTERVAL`` seconds.
+
+    Called when uploads finish, sessions are created and jobs are queued, so
+    outputs that are never downloaded expire without waiting for some other
+    download to complete.
+    """
+    global _last_purge
+    if not _purge_lock.acquire(blocking=False):
+        return  # Another request is purging
+    try:
+        if time.time() - _last_purge < app.config['PURGE_INTERVAL']:
+            return
+        _last_purge = time.time()
+        purge_expired_outputs()
+    except Exception as e:
+        print(f"Error purging expired outputs: {e}")
+    finally:
+        _purge_lock.release()
+
 
 @app.route('/', methods=['GET', 'POST'])
 def index():
     if request.method == 'POST':
         num_files = int(request.form['num_files'])
-        return render_template('upload.html', num_files=num_files)
+        return render_template('upload.html', num_files=num_files,
+                               async_jobs=app.config['ASYNC_JOBS'],
+                               client_pdf=client_pdf_settings())
     return render_template('index.html')
 
 
+# Sent instead of the engine's message, which includes storage paths and content digests
+MERGE_ERROR_MESSAGE = 'Error merging PDF: a file could not be read as a PDF or image'
+
+
 @app.route('/merge', methods=['POST'])
 def merge_pdfs():
     try:
-        merger = PdfMerger()
         uploaded_files = request.files.getlist('pdf_files')
 
         if not uploaded_files or len(uploaded_files) == 0:
             return jsonify({'error': 'No files uploaded'}), 400
 
+        purge_expired_outputs_soon()
         file_paths = []
         total_size = 0
+        owner = _upload_owner()
         
         # Adjusted for Vercel limits (50MB per file for safety)
         MAX_FILE_SIZE = 50 * 1024 * 1024  # 50MB per file
         
-        for idx, file in enumerate(uploaded_files):
+        for file in uploaded_files:
             if file.filename != '':
                 # Validate file size (individual file should not exceed 100MB)
                 file.seek(0, os.SEEK_END)
@@ -57,53 +751,41 @@ def merge_pdfs():
                 file.seek(0)
                 
                 if file_size > MAX_FILE_SIZE:
+                    blob_store.release_paths(file_paths)
                     return jsonify({'error': f'File {file.filename} exceeds {MAX_FILE_SIZE/(1024*1024)}MB limit'}), 400
                 
                 total_size += file_size
                 
-                # Create unique filename to allow same file in multiple slots
-                original_filename = secure_filename(file.filename)
-                unique_filename = f"{uuid.uuid4().hex}_{idx}_{original_filename}"
-                path = os.path.join(app.config['UPLOAD_FOLDER'], unique_filename)
+                # The same file in several slots is stored once and referenced per slot
+                with timed('save'):
+                    digest = blob_store.add_stream(file.stream, owner=owner)
                 
-                # Save in chunks for large files
-                with open(path, 'wb') as f:
-                    while True:
-                        chunk = file.read(8192)  # 8KB chunks
-                        if not chunk:
-                            break
-                        f.write(chunk)
-                
-                file_paths.append(path)
-
-        # Merge PDFs with better memory management
-        for path in file_paths:
-            try:
-                merger.append(path)
-            except Exception as e:
-                # Clean up on error
-                for p in file_paths:
-                    if os.path.exists(p):
-                        os.remove(p)
-                return jsonify({'error': f'Error merging PDF: {str(e)}'}), 500
+                file_paths.append(blob_store.path(digest))
 
         output_filename = f"merged_{uuid.uuid4().hex}.pdf"
         output_path = os.path.join(app.config['MERGED_FOLDER'], output_filename)
-        merger.write(output_path)
-        merger.close()
+        
+        # Merge PDFs (and images, converted to pages) with the configured engine
+        try:
+            merge_files(file_paths, output_path, image_dpi=_requested_image_dpi())
+        except Exception as e:
+            # Engine messages name the blob files; keep them in the log
+            print(f"Error merging PDF: {e}")
+            return jsonify({'error': MERGE_ERROR_MESSAGE}), 500
+        finally:
+            # Uploaded blobs stay around for a while in case they are used again
+            with timed('cleanup'):
+                blob_store.release_paths(file_paths)
 
-        # Clean uploaded files
-        for path in file_paths:
-            if os.path.exists(path):
-                os.remove(path)
+        optimization = optimize_pdf(output_path, _requested_optimize_level())
 
-        return jsonify({'success': True, 'filename': output_filename})
+        return jsonify({'success': True, 'filename': output_filename, 'optimization': optimization})
     
     except Exception as e:
         print(f"Error in merge_pdfs: {e}")
         import traceback
         traceback.print_exc()
-        return jsonify({'error': f'An error occurred: {str(e)}'}), 500
+        return jsonify({'error': 'An error occurred while merging'}), 500
 
 
 @app.route('/download/<filename>', methods=['GET'])
@@ -116,15 +798,8 @@ def download(filename):
         if not os.path.exists(output_path):
             return "File not found", 404
         
-        response = send_file(output_path, as_attachment=True, download_name='merged.pdf')
-        
-        # Clean up after download
-        try:
-            os.remove(output_path)
-        except:
-            pass
-            
-        return response
+        # The file is removed DOWNLOAD_RETENTION after the last download
+        return send_output(output_path, 'merged.pdf')
     except Exception as e:
         print(f"Error in download: {e}")
         return "Error downloading file", 500
@@ -144,52 +819,445 @@ def merge_result():
 
 # CHUNKED UPLOAD ROUTES (for large files on free plan)
 
+def _execute_sql(db_path, sql, params=()):
+    with closing(sqlite3.connect(db_path, timeout=10)) as conn:
+        with conn:
+            return conn.execute(sql, params).fetchall()
+
+
+class BlobStore:
+    """Content-addressed store for uploaded PDFs and images.
+
+    Each distinct file is kept once, at ``<folder>/<d[:2]>/<d>.pdf`` where
+    ``d`` is its BLAKE2b digest, with a reference count in SQLite shared by all
+    worker processes. Callers get a reference from ``add_*`` or ``acquire``
+    and give it back with ``release``; blobs nobody references are deleted
+    once they have been unused for ``ttl`` seconds, so a file uploaded again
+    within that window is neither stored nor parsed a second time. A SHA-256
+    digest is recorded as well, because that is what browsers can compute.
+    """
+
+    def __init__(self, folder, db_path, ttl):
+        self.folder = folder
+        self.db_path = db_path
+        self.ttl = ttl
+        _execute_sql(db_path,
+                     'CREATE TABLE IF NOT EXISTS blobs ('
+                     'digest TEXT PRIMARY KEY, sha256 TEXT, size INTEGER, refs INTEGER, last_used REAL)')
+        _execute_sql(db_path, 'CREATE INDEX IF NOT EXISTS blobs_sha256 ON blobs (sha256)')
+        _execute_sql(db_path,
+                     'CREATE TABLE IF NOT EXISTS blob_owners (digest TEXT, owner TEXT, PRIMARY KEY (digest, owner))')
+
+    @contextmanager
+    def _transaction(self):
+        # BEGIN IMMEDIATE serializes file moves and deletes across processes
+        with closing(sqlite3.connect(self.db_path, timeout=10, isolation_level=None)) as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+                conn.execute('COMMIT')
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+
+    def path(self, digest):
+        return os.path.join(self.folder, digest[:2], f'{digest}.pdf')
+
+    @staticmethod
+    def digest_of(path):
+        """Return the digest of a blob path"""
+        return os.path.splitext(os.path.basename(path))[0]
+
+    def add_stream(self, stream, owner=None):
+        """Store the contents of a file-like object, hashing while it is written"""
+        tmp_path = os.path.join(self.folder, f'{uuid.uuid4().hex}.tmp')
+        digest, sha256 = hashlib.blake2b(), hashlib.sha256()
+        try:
+            with open(tmp_path, 'wb') as f:
+                for block in iter(lambda: stream.read(1024 * 1024), b''):
+                    digest.update(block)
+                    sha256.update(block)
+                    f.write(block)
+            return self._adopt(tmp_path, digest.hexdigest(), sha256.hexdigest(), owner)
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+
+    def add_file(self, path, owner=None):
+        """Move a file on disk into the store"""
+        digest, sha256 = hashlib.blake2b(), hashlib.sha256()
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(block)
+                sha256.update(block)
+        try:
+            return self._adopt(path, digest.hexdigest(), sha256.hexdigest(), owner)
+        finally:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def _adopt(self, tmp_path, digest, sha256, owner):
+        blob_path = self.path(digest)
+        with self._transaction() as conn:
+            conn.execute(
+                'INSERT INTO blobs (digest, sha256, size, refs, last_used) VALUES (?, ?, ?, 1, ?) '
+                'ON CONFLICT (digest) DO UPDATE SET refs = refs + 1, last_used = excluded.last_used',
+                (digest, sha256, os.path.getsize(tmp_path), time.time())
+            )
+            if owner:
+                conn.execute('INSERT OR IGNORE INTO blob_owners (digest, owner) VALUES (?, ?)', (digest, owner))
+            if not os.path.exists(blob_path):
+                os.makedirs(os.path.dirname(blob_path), exist_ok=True)
+                os.replace(tmp_path, blob_path)
+        return digest
+
+    def find(self, sha256, size, owner):
+        """Return the digest of a stored blob ``owner`` uploaded before, or None.
+
+        Limiting matches to the owner's own uploads means knowing a hash is
+        never enough to obtain someone else's file.
+        """
+        rows = _execute_sql(
+            self.db_path,
+            'SELECT blobs.digest FROM blobs JOIN blob_owners ON blob_owners.digest = blobs.digest '
+            'WHERE blobs.sha256 = ? AND blobs.size = ? AND blob_owners.owner = ?',
+            (sha256, size, owner)
+        )
+        for (digest,) in rows:
+            if os.path.exists(self.path(digest)):
+                return digest
+        return None
+
+    def acquire(self, digest):
+        """Take another reference on a stored blob; returns False if it is gone"""
+        with self._transaction() as conn:
+            updated = conn.execute('UPDATE blobs SET refs = refs + 1, last_used = ? WHERE digest = ?',
+                                   (time.time(), digest)).rowcount
+        return bool(updated)
+
+    def release(self, digest):
+        """Give back a reference taken by ``add_*`` or ``acquire``"""
+        _execute_sql(self.db_path, 'UPDATE blobs SET refs = MAX(refs - 1, 0), last_used = ? WHERE digest = ?',
+                     (time.time(), digest))
+
+    def release_paths(self, paths):
+        for path in paths:
+            self.release(self.digest_of(path))
+
+    def link(self, digest, dest_path):
+        """Give ``dest_path`` the blob's contents, hard-linking where possible"""
+        try:
+            os.link(self.path(digest), dest_path)
+        except OSError:
+            import shutil
+            shutil.copyfile(self.path(digest), dest_path)
+
+    def purge_expired(self):
+        """Delete blobs that have been unreferenced for longer than ``ttl``"""
+        cutoff = time.time() - self.ttl
+        with self._transaction() as conn:
+            expired = [digest for (digest,) in conn.execute(
+                'SELECT digest FROM blobs WHERE refs <= 0 AND last_used < ?', (cutoff,))]
+            for digest in expired:
+                conn.execute('DELETE FROM blobs WHERE digest = ?', (digest,))
+                conn.execute('DELETE FROM blob_owners WHERE digest = ?', (digest,))
+                try:
+                    os.remove(self.path(digest))
+                except OSError:
+                    pass
+        for digest in expired:
+            document_pool.discard(self.path(digest))
+
+
+blob_store = BlobStore(app.config['BLOB_FOLDER'], app.config['UPLOAD_REGISTRY_PATH'], app.config['UPLOAD_TTL'])
+
+
+class UploadRegistry:
+    """Index of finalized uploads keyed by fileId.
+
+    Records are kept in SQLite so every worker process sees the same uploads;
+    they are not cached in memory, because job workers and other server
+    processes remove them. Each record holds the
+    blob path, size, original name, BLAKE2 checksum (the blob digest), state
+    and owner of an upload, and owns one reference on its blob. Records older
+    than ``ttl`` seconds are treated as gone and purged.
+    """
+
+    FIELDS = ('file_id', 'path', 'size', 'filename', 'checksum', 'state', 'owner', 'created_at')
+
+    def __init__(self, db_path, ttl):
+        self.db_path = db_path
+        self.ttl = ttl
+        self._execute(
+            'CREATE TABLE IF NOT EXISTS uploads ('
+            'file_id TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER, filename TEXT, '
+            'checksum TEXT, state TEXT, owner TEXT, created_at REAL)'
+        )
+        self._execute('CREATE INDEX IF NOT EXISTS uploads_created_at ON uploads (created_at)')
+
+    def _execute(self, sql, params=()):
+        return _execute_sql(self.db_path, sql, params)
+
+    def register(self, file_id, digest, filename, owner=None, state='complete'):
+        """Record a finalized upload, handing it one reference on blob ``digest``"""
+        path = blob_store.path(digest)
+        record = {
+            'file_id': file_id,
+            'path': path,
+            'size': os.path.getsize(path),
+            'filename': filename,
+            'checksum': digest,
+            'state': state,
+            'owner': owner,
+            'created_at': time.time()
+        }
+        replaced = self._execute('SELECT checksum FROM uploads WHERE file_id = ?', (file_id,))
+        self._execute(
+            f"INSERT OR REPLACE INTO uploads ({', '.join(self.FIELDS)}) VALUES ({', '.join('?' * len(self.FIELDS))})",
+            [record[field] for field in self.FIELDS]
+        )
+        for (old_digest,) in replaced:
+            blob_store.release(old_digest)
+        self.purge_expired()
+        return record
+
+    def get(self, file_id, owner=None):
+        """Return the record for ``file_id``, or None if unknown, expired or owned by someone else"""
+        rows = self._execute(f"SELECT {', '.join(self.FIELDS)} FROM uploads WHERE file_id = ?", (file_id,))
+        if not rows:
+            return None
+        record = dict(zip(self.FIELDS, rows[0]))
+        if time.time() - record['created_at'] > self.ttl:
+            return None
+        if record['owner'] and owner and record['owner'] != owner:
+            return None
+        if not os.path.exists(record['path']):
+            self.remove(file_id)
+            return None
+        return record
+
+    def remove(self, file_id):
+        """Forget an upload and release its blob reference"""
+        # RETURNING makes sure a file removed twice only releases its blob once
+        for (digest,) in self._execute('DELETE FROM uploads WHERE file_id = ? RETURNING checksum', (file_id,)):
+            blob_store.release(digest)
+
+    def purge_expired(self):
+        """Forget expired uploads and delete blobs nothing references any more"""
+        cutoff = time.time() - self.ttl
+        for (file_id,) in self._execute('SELECT file_id FROM uploads WHERE created_at < ?', (cutoff,)):
+            try:
+                self.remove(file_id)
+            except sqlite3.Error as e:
+                print(f"Error purging upload {file_id}: {e}")
+        blob_store.purge_expired()
+
+
+upload_registry = UploadRegistry(app.config['UPLOAD_REGISTRY_PATH'], app.config['UPLOAD_TTL'])
+
+
+def _upload_owner():
+    """Return the browser's upload owner token, issuing one if it has none"""
+    owner = request.cookies.get('upload_owner')
+    if not owner:
+        owner = g.get('new_upload_owner') or uuid.uuid4().hex
+        g.new_upload_owner = owner
+    return owner
+
+
+@app.after_request
+def set_upload_owner_cookie(response):
+    if g.get('new_upload_owner'):
+        response.set_cookie('upload_owner', g.new_upload_owner, httponly=True, samesite='Lax')
+    return response
+
+
+def _upload_state_dir(file_id):
+    return os.path.join(app.config['UPLOAD_FOLDER'], file_id)
+
+
+def _final_upload_path(file_id, original_filename):
+    return os.path.join(app.config['UPLOAD_FOLDER'], f"{file_id}_{secure_filename(original_filename)}")
+
+
+def _init_upload(state_dir, meta):
+    """Record upload parameters on the first chunk and return the agreed values.
+
+    Chunks may arrive in any order and in parallel, so whichever request gets
+    here first creates the preallocated data file and the received-chunk
+    folder; the rest read back what it recorded. The state directory is
+    built under a temporary name and renamed into place complete, so no chunk
+    sees the metadata before the files it describes.
+    """
+    import shutil
+    meta_path = os.path.join(state_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        purge_abandoned_uploads()
+        tmp_dir = f"{state_dir}.{uuid.uuid4().hex}.tmp"
+        os.makedirs(tmp_dir)
+        try:
+            with open(os.path.join(tmp_dir, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+            with open(os.path.join(tmp_dir, 'data.part'), 'wb') as f:
+                f.truncate(meta['total_size'])
+            # One empty file per chunk, created once that chunk is fully written
+            os.makedirs(os.path.join(tmp_dir, 'received'))
+            # Renaming is atomic and fails if another chunk won the race
+            os.rename(tmp_dir, state_dir)
+        except OSError:
+            if not os.path.exists(meta_path):
+                raise
+        finally:
+            shutil.rmtree(tmp_dir, ignore_errors=True)
+    with open(meta_path) as f:
+        return json.load(f)
+
+
+def _upload_last_activity(state_dir):
+    # Written chunks touch data.part and add a file to received/
+    times = []
+    for path in (state_dir, os.path.join(state_dir, 'data.part'), os.path.join(state_dir, 'received')):
+        try:
+            times.append(os.path.getmtime(path))
+        except OSError:
+            pass
+    return max(times, default=0)
+
+
+def purge_abandoned_uploads():
+    """Delete chunked uploads that have not received a chunk for ``UPLOAD_TTL`` seconds.
+
+    Their preallocated ``data.part`` is as large as the whole declared file,
+    so an upload the client gave up on would otherwise hold that space forever.
+    """
+    import shutil
+    cutoff = time.time() - app.config['UPLOAD_TTL']
+    for entry in os.scandir(app.config['UPLOAD_FOLDER']):
+        if entry.is_dir() and entry.path != app.config['BLOB_FOLDER'] and _upload_last_activity(entry.path) < cutoff:
+            shutil.rmtree(entry.path, ignore_errors=True)
+
+
+def _received_chunks(state_dir):
+    """Return the list of chunk numbers already written for an upload"""
+    try:
+        # Only chunks that actually arrived are listed, whatever count the client declared
+        return sorted(int(name) for name in os.listdir(os.path.join(state_dir, 'received')) if name.isdigit())
+    except FileNotFoundError:
+        return []
+
+
+def _upload_layout_error(total_size, total_chunks, chunk_size):
+    """Return why a declared upload layout is unacceptable, or None"""
+    if total_size < 1:
+        return 'File is empty'
+    if total_size > app.config['UPLOAD_MAX_FILE_SIZE']:
+        return f"File exceeds {app.config['UPLOAD_MAX_FILE_SIZE'] / (1024 * 1024):.0f}MB limit"
+    if chunk_size < 1 or (total_chunks > 1 and chunk_size < app.config['UPLOAD_MIN_CHUNK_SIZE']):
+        return 'Chunk size is too small'
+    if total_chunks != -(-total_size // chunk_size):
+        return 'Chunk count does not match the file and chunk sizes'
+    return None
+
+
 @app.route('/upload-chunk', methods=['POST'])
 def upload_chunk():
-    """Handle chunked file uploads to bypass 4.5MB limit"""
+    """Handle chunked file uploads to bypass 4.5MB limit.
+
+    Each chunk is written straight into a preallocated file at
+    ``chunkNumber * chunkSize``, so chunks can be sent in parallel, out of
+    order, or again after a failure. The upload is finalized as soon as every
+    chunk has been received.
+    """
     try:
         chunk = request.files.get('chunk')
         chunk_number = int(request.form.get('chunkNumber'))
         total_chunks = int(request.form.get('totalChunks'))
+        chunk_size = int(request.form.get('chunkSize', app.config['CHUNK_SIZE']))
+        total_size = request.form.get('totalSize', type=int)
         file_id = request.form.get('fileId')
         original_filename = request.form.get('filename')
         
-        if not all([chunk, file_id, original_filename]):
+        # Without totalSize the last chunk's length is unknown, and the file would be stored padded
+        if not all([chunk, file_id, original_filename]) or total_size is None:
             return jsonify({'error': 'Missing required parameters'}), 400
         
-        # Create temp directory for chunks
-        chunk_dir = os.path.join(app.config['UPLOAD_FOLDER'], file_id)
-        os.makedirs(chunk_dir, exist_ok=True)
+        layout_error = _upload_layout_error(total_size, total_chunks, chunk_size)
+        if layout_error:
+            return jsonify({'error': layout_error}), 400
         
-        # Save chunk
-        chunk_path = os.path.join(chunk_dir, f'chunk_{chunk_number}')
-        chunk.save(chunk_path)
+        file_id = secure_filename(file_id)
+        final_path = _final_upload_path(file_id, original_filename)
         
-        # If all chunks received, combine them
-        if chunk_number == total_chunks - 1:
-            final_path = os.path.join(app.config['UPLOAD_FOLDER'], f"{file_id}_{secure_filename(original_filename)}")
-            
-            with open(final_path, 'wb') as final_file:
-                for i in range(total_chunks):
-                    chunk_path = os.path.join(chunk_dir, f'chunk_{i}')
-                    with open(chunk_path, 'rb') as chunk_file:
-                        final_file.write(chunk_file.read())
-                    os.remove(chunk_path)
-            
-            # Remove chunk directory
-            os.rmdir(chunk_dir)
-            
+        owner = _upload_owner()
+        
+        # A retried chunk of an upload that already completed
+        record = upload_registry.get(file_id, owner=owner)
+        if record:
+            return jsonify({'success': True, 'complete': True, 'filePath': record['path'], 'fileId': file_id})
+        
+        state_dir = _upload_state_dir(file_id)
+        meta = _init_upload(state_dir, {
+            'filename': original_filename,
+            'total_chunks': total_chunks,
+            'chunk_size': chunk_size,
+            'total_size': total_size
+        })
+        chunk_size = meta['chunk_size']
+        total_size = meta['total_size']
+        
+        if total_chunks != meta['total_chunks'] or not 0 <= chunk_number < total_chunks:
+            return jsonify({'error': 'Invalid chunk number'}), 400
+        
+        # Write the chunk in place, streaming it from the request
+        offset = chunk_number * chunk_size
+        limit = min(chunk_size, total_size - offset)
+        fd = os.open(os.path.join(state_dir, 'data.part'), os.O_WRONLY | os.O_CREAT)
+        try:
+            with timed('save'):
+                written = 0
+                while True:
+                    data = chunk.stream.read(64 * 1024)
+                    if not data:
+                        break
+                    if written + len(data) > limit:
+                        return jsonify({'error': 'Chunk exceeds declared size'}), 400
+                    os.pwrite(fd, data, offset + written)
+                    written += len(data)
+        finally:
+            os.close(fd)
+        
+        if written != limit:
+            return jsonify({'error': 'Chunk is shorter than declared'}), 400
+        
+        # Mark the chunk as received only once all of its bytes are on disk
+        open(os.path.join(state_dir, 'received', str(chunk_number)), 'wb').close()
+        
+        received = _received_chunks(state_dir)
+        if len(received) < total_chunks:
             return jsonify({
                 'success': True,
-                'complete': True,
-                'filePath': final_path,
-                'fileId': file_id
+                'complete': False,
+                'chunkNumber': chunk_number,
+                'receivedChunks': len(received)
             })
         
+        # All chunks received; the rename makes exactly one request the finalizer
+        try:
+            os.rename(os.path.join(state_dir, 'data.part'), final_path)
+            digest = blob_store.add_file(final_path, owner=owner)
+            upload_registry.register(file_id, digest, original_filename, owner=owner)
+        except FileNotFoundError:
+            pass  # Finalized by a concurrent request
+        import shutil
+        shutil.rmtree(state_dir, ignore_errors=True)
+        record = upload_registry.get(file_id, owner=owner)
+        purge_expired_outputs_soon()
+        
         return jsonify({
             'success': True,
-            'complete': False,
-            'chunkNumber': chunk_number
+            'complete': True,
+            'filePath': record['path'] if record else None,
+            'fileId': file_id
         })
         
     except Exception as e:
@@ -199,6 +1267,64 @@ def upload_chunk():
         return jsonify({'error': str(e)}), 500
 
 
+@app.route('/upload-status/<file_id>', methods=['GET'])
+def upload_status(file_id):
+    """Report which chunks of an upload have arrived so clients can resume"""
+    try:
+        file_id = secure_filename(file_id)
+        
+        if upload_registry.get(file_id, owner=_upload_owner()):
+            return jsonify({'fileId': file_id, 'complete': True, 'receivedChunks': []})
+        
+        state_dir = _upload_state_dir(file_id)
+        meta_path = os.path.join(state_dir, 'meta.json')
+        if not os.path.exists(meta_path):
+            return jsonify({'fileId': file_id, 'complete': False, 'receivedChunks': []})
+        
+        with open(meta_path) as f:
+            meta = json.load(f)
+        
+        return jsonify({
+            'fileId': file_id,
+            'complete': False,
+            'totalChunks': meta['total_chunks'],
+            'chunkSize': meta['chunk_size'],
+            'receivedChunks': _received_chunks(state_dir)
+        })
+    except Exception as e:
+        print(f"Error in upload_status: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/upload-check', methods=['POST'])
+def upload_check():
+    """Complete an upload without sending it when this browser uploaded the same content before"""
+    try:
+        file_id = request.form.get('fileId')
+        filename = request.form.get('filename')
+        sha256 = request.form.get('sha256', '').lower()
+        size = request.form.get('size', type=int)
+        
+        if not all([file_id, filename, sha256]) or size is None:
+            return jsonify({'error': 'Missing required parameters'}), 400
+        
+        file_id = secure_filename(file_id)
+        owner = _upload_owner()
+        
+        if upload_registry.get(file_id, owner=owner):
+            return jsonify({'fileId': file_id, 'complete': True})
+        
+        digest = blob_store.find(sha256, size, owner)
+        if digest and blob_store.acquire(digest):
+            upload_registry.register(file_id, digest, filename, owner=owner)
+            return jsonify({'fileId': file_id, 'complete': True})
+        
+        return jsonify({'fileId': file_id, 'complete': False})
+    except Exception as e:
+        print(f"Error in upload_check: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
 @app.route('/merge-chunked', methods=['POST'])
 def merge_chunked():
     """Merge PDFs that were uploaded in chunks"""
@@ -208,49 +1334,48 @@ def merge_chunked():
         if not file_ids or len(file_ids) == 0:
             return jsonify({'error': 'No files provided'}), 400
         
-        merger = PdfMerger()
         file_paths = []
+        found_ids = []
+        owner = _upload_owner()
         
         # Find uploaded files by ID
         for file_id in file_ids:
-            # Find file in upload folder
-            for filename in os.listdir(app.config['UPLOAD_FOLDER']):
-                if filename.startswith(file_id + '_'):
-                    file_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-                    file_paths.append(file_path)
-                    break
+            record = upload_registry.get(secure_filename(file_id), owner=owner)
+            if record:
+                file_paths.append(record['path'])
+                found_ids.append(record['file_id'])
         
         if len(file_paths) == 0:
             return jsonify({'error': 'No uploaded files found'}), 404
         
-        # Merge PDFs
-        for path in file_paths:
-            try:
-                merger.append(path)
-            except Exception as e:
-                # Clean up on error
-                for p in file_paths:
-                    if os.path.exists(p):
-                        os.remove(p)
-                return jsonify({'error': f'Error merging PDF: {str(e)}'}), 500
-        
         output_filename = f"merged_{uuid.uuid4().hex}.pdf"
         output_path = os.path.join(app.config['MERGED_FOLDER'], output_filename)
-        merger.write(output_path)
-        merger.close()
+        
+        # Merge PDFs
+        try:
+            merge_files(file_paths, output_path, image_dpi=_requested_image_dpi())
+        except Exception as e:
+            # Clean up on error
+            for file_id in found_ids:
+                upload_registry.remove(file_id)
+            # Engine messages name the blob files; keep them in the log
+            print(f"Error merging PDF: {e}")
+            return jsonify({'error': MERGE_ERROR_MESSAGE}), 500
         
         # Clean uploaded files
-        for path in file_paths:
-            if os.path.exists(path):
-                os.remove(path)
+        with timed('cleanup'):
+            for file_id in found_ids:
+                upload_registry.remove(file_id)
+        
+        optimization = optimize_pdf(output_path, _requested_optimize_level())
         
-        return jsonify({'success': True, 'filename': output_filename})
+        return jsonify({'success': True, 'filename': output_filename, 'optimization': optimization})
     
     except Exception as e:
         print(f"Error in merge_chunked: {e}")
         import traceback
         traceback.print_exc()
-        return jsonify({'error': f'An error occurred: {str(e)}'}), 500
+        return jsonify({'error': 'An error occurred while merging'}), 500
 
 
 # PDF EDITING ROUTES
@@ -265,14 +1390,33 @@ def edit_mode():
 def edit_pages():
     """Show the page editor"""
     session_id = request.args.get('session_id')
-    total_pages = request.args.get('total_pages', 0, type=int)
     
-    if not session_id or total_pages == 0:
+    manifest = load_session_manifest(secure_filename(session_id)) if session_id else None
+    if not manifest:
         return redirect(url_for('edit_mode'))
     
+    # Page shapes let the editor lay out placeholders before any thumbnail loads
     return render_template('edit_pages.html', 
                           session_id=session_id, 
-                          total_pages=total_pages)
+                          total_pages=manifest['page_count'],
+                          page_ratios=page_aspect_ratios(manifest),
+                          async_jobs=app.config['ASYNC_JOBS'],
+                          client_pdf=client_pdf_settings(
+                              sourceBytes=manifest['size'],
+                              sourceUrl=url_for('edit_source', session_id=session_id),
+                              editAllowed=(manifest['page_count'] <= app.config['CLIENT_PDF_MAX_PAGES']
+                                           and not manifest['structure']['encrypted'])))
+
+
+@app.route('/edit-source/<session_id>', methods=['GET'])
+def edit_source(session_id):
+    """Serve the session's original PDF for edits the browser applies itself"""
+    safe_session_id = secure_filename(session_id)
+    if load_session_manifest(safe_session_id) is None:
+        return "File not found", 404
+    # Not a download: it doesn't start the session's retention window
+    return send_file(os.path.join(app.config['EDIT_FOLDER'], safe_session_id, 'original.pdf'),
+                     mimetype='application/pdf', conditional=True)
 
 
 @app.route('/process-chunked-edit', methods=['POST'])
@@ -286,13 +1430,8 @@ def process_chunked_edit():
             return jsonify({'error': 'Missing file information'}), 400
         
         # Find the uploaded file
-        uploaded_file = None
-        for fname in os.listdir(app.config['UPLOAD_FOLDER']):
-            if fname.startswith(file_id + '_'):
-                uploaded_file = os.path.join(app.config['UPLOAD_FOLDER'], fname)
-                break
-        
-        if not uploaded_file or not os.path.exists(uploaded_file):
+        record = upload_registry.get(secure_filename(file_id), owner=_upload_owner())
+        if not record:
             return jsonify({'error': 'Uploaded file not found'}), 404
         
         # Create session for editing
@@ -300,22 +1439,22 @@ def process_chunked_edit():
         session_dir = os.path.join(app.config['EDIT_FOLDER'], session_id)
         os.makedirs(session_dir, exist_ok=True)
         
-        # Move file to session directory
-        session_pdf_path = os.path.join(session_dir, 'original.pdf')
+        # Link the uploaded blob into the session directory
+        with timed('save'):
+            blob_store.link(record['checksum'], os.path.join(session_dir, 'original.pdf'))
         
-        # Copy instead of move to handle cross-device issues
-        import shutil
-        shutil.copy2(uploaded_file, session_pdf_path)
-        os.remove(uploaded_file)
+        # Describe the PDF once, reusing the parsed blob if it was opened before
+        with timed('parse'), document_pool.borrow(record['path'], record['path']) as doc:
+            manifest = write_session_manifest(session_dir, doc, record['checksum'])
+        upload_registry.remove(record['file_id'])
         
-        # Get total pages
-        reader = PdfReader(session_pdf_path)
-        total_pages = len(reader.pages)
+        schedule_prerender(session_id)
+        purge_expired_outputs_soon()
         
         return jsonify({
             'success': True,
             'session_id': session_id,
-            'total_pages': total_pages
+            'total_pages': manifest['page_count']
         })
         
     except Exception as e:
@@ -349,23 +1488,26 @@ def process_upload_for_edit():
         session_dir = os.path.join(app.config['EDIT_FOLDER'], session_id)
         os.makedirs(session_dir, exist_ok=True)
         
-        # Save uploaded PDF in chunks for large files
-        pdf_path = os.path.join(session_dir, 'original.pdf')
-        with open(pdf_path, 'wb') as f:
-            while True:
-                chunk = pdf_file.read(8192)  # 8KB chunks
-                if not chunk:
-                    break
-                f.write(chunk)
+        # Store the upload by content and link it into the session directory
+        with timed('save'):
+            digest = blob_store.add_stream(pdf_file.stream, owner=_upload_owner())
+            blob_store.link(digest, os.path.join(session_dir, 'original.pdf'))
         
-        # Get total pages
-        reader = PdfReader(pdf_path)
-        total_pages = len(reader.pages)
+        # Describe the PDF once, reusing the parsed blob if it was opened before
+        blob_path = blob_store.path(digest)
+        try:
+            with timed('parse'), document_pool.borrow(blob_path, blob_path) as doc:
+                manifest = write_session_manifest(session_dir, doc, digest)
+        finally:
+            blob_store.release(digest)
+        
+        schedule_prerender(session_id)
+        purge_expired_outputs_soon()
         
         return jsonify({
             'success': True,
             'session_id': session_id,
-            'total_pages': total_pages
+            'total_pages': manifest['page_count']
         })
         
     except Exception as e:
@@ -381,37 +1523,46 @@ def page_image(session_id, page_num):
     try:
         # Sanitize session_id to prevent directory traversal
         safe_session_id = secure_filename(session_id)
-        pdf_path = os.path.join(app.config['EDIT_FOLDER'], safe_session_id, 'original.pdf')
+        session_dir = os.path.join(app.config['EDIT_FOLDER'], safe_session_id)
         
-        # Check if file exists
-        if not os.path.exists(pdf_path):
+        # Check if the session exists
+        manifest = load_session_manifest(safe_session_id)
+        if not manifest or not os.path.exists(os.path.join(session_dir, 'original.pdf')):
             return "PDF not found", 404
         
-        # Open PDF with PyMuPDF
-        doc = fitz.open(pdf_path)
-        
         # Validate page number
-        if page_num < 1 or page_num > len(doc):
-            doc.close()
+        if page_num < 1 or page_num > manifest['page_count']:
             return "Invalid page number", 404
         
-        page = doc[page_num - 1]  # PyMuPDF uses 0-based indexing
+        options = preview_request_options()
+        if options is None:
+            return "Invalid preview tier", 400
+        tier, fmt = options
+        mimetype, extension = PREVIEW_FORMATS[fmt]
         
-        # Render page to image with optimized settings for large files
-        # Use lower resolution for faster generation
-        pix = page.get_pixmap(matrix=fitz.Matrix(0.8, 0.8), alpha=False)
+        # A matching ETag costs neither a render nor a cache read
+        etag = preview_etag(manifest, page_num, tier, fmt)
+        if request.if_none_match.contains_weak(etag):
+            return cache_preview(Response(status=304), etag)
         
-        # Convert to JPEG with lower quality for faster loading and smaller size
-        img_data = pix.tobytes("jpeg", jpg_quality=60)
+        # Serve from the thumbnail cache when the page was already rendered
+        cached_path = thumbnail_cache.get(session_dir, page_num, tier, fmt)
+        if cached_path:
+            return cache_preview(send_file(cached_path, mimetype=mimetype, as_attachment=False,
+                                           download_name=f'page_{page_num}.{extension}'), etag)
         
-        doc.close()
+        # Reuse the session's open PyMuPDF document
+        with borrow_session_document(safe_session_id, manifest) as doc:
+            img_data = render_page_thumbnail(doc, page_num, tier, fmt)
+
+        thumbnail_cache.put(session_dir, page_num, img_data, tier, fmt)
         
-        return send_file(
+        return cache_preview(send_file(
             io.BytesIO(img_data),
-            mimetype='image/jpeg',
+            mimetype=mimetype,
             as_attachment=False,
-            download_name=f'page_{page_num}.jpg'
-        )
+            download_name=f'page_{page_num}.{extension}'
+        ), etag)
     except Exception as e:
         print(f"Error generating page image for page {page_num}: {e}")
         import traceback
@@ -419,6 +1570,195 @@ def page_image(session_id, page_num):
         return f"Error generating image: {str(e)}", 500
 
 
+@app.route('/page-images/<session_id>', methods=['GET'])
+def page_images(session_id):
+    """Stream previews for a page range as NDJSON, one page per line"""
+    try:
+        safe_session_id = secure_filename(session_id)
+        pdf_path = os.path.join(app.config['EDIT_FOLDER'], safe_session_id, 'original.pdf')
+        manifest = load_session_manifest(safe_session_id)
+        
+        if not manifest or not os.path.exists(pdf_path):
+            return jsonify({'error': 'PDF not found'}), 404
+        
+        start = request.args.get('start', 1, type=int)
+        end = request.args.get('end', start, type=int)
+        total_pages = manifest['page_count']
+        
+        # Validate and clamp the requested range
+        if start < 1 or start > total_pages or end < start:
+            return jsonify({'error': 'Invalid page range'}), 400
+        end = min(end, total_pages, start + app.config['THUMBNAIL_BATCH_MAX_PAGES'] - 1)
+        
+        # The stream is NDJSON, so the image format comes from ?format= rather than Accept
+        options = preview_request_options(use_accept=False)
+        if options is None:
+            return jsonify({'error': 'Invalid preview tier'}), 400
+        tier, fmt = options
+        mimetype = PREVIEW_FORMATS[fmt][0]
+        
+        etag = preview_etag(manifest, f'{start}-{end}', tier, fmt)
+        if request.if_none_match.contains_weak(etag):
+            response = cache_preview(Response(status=304), etag, use_accept=False)
+            response.headers['X-Page-Range'] = f'{start}-{end}'
+            return response
+        
+        # Headers go out before any page is rendered, and a page that fails becomes an
+        # error line; only a range served entirely from the thumbnail cache is immutable
+        session_dir = os.path.join(app.config['EDIT_FOLDER'], safe_session_id)
+        all_cached = all(thumbnail_cache.get(session_dir, page_num, tier, fmt) for page_num in range(start, end + 1))
+        
+        def generate():
+            for page_num in range(start, end + 1):
+                try:
+                    img_data = load_page_thumbnail(safe_session_id, page_num, tier, fmt)
+                    line = {'page': page_num, 'type': mimetype, 'image': base64.b64encode(img_data).decode('ascii')}
+                except Exception as e:
+                    print(f"Error generating page image for page {page_num}: {e}")
+                    line = {'page': page_num, 'error': str(e)}
+                yield json.dumps(line) + '\n'
+        
+        response = Response(stream_with_context(generate()), mimetype='application/x-ndjson')
+        response.headers['X-Page-Range'] = f'{start}-{end}'
+        if all_cached:
+            return cache_preview(response, etag, use_accept=False)
+        response.headers['Cache-Control'] = 'no-store'
+        return response
+    except Exception as e:
+        print(f"Error in page_images: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+
+def save_insert_files():
+    """Store the request's insert_after_* uploads (PDFs or images) in the blob store.
+
+    Returns a dict mapping each form key to blob paths, in upload order. Each
+    path carries a blob reference; give them back with ``release_insertions``.
+    """
+    insertions = {}
+    owner = _upload_owner()
+    for key in request.files.keys():
+        if not key.startswith('insert_after_'):
+            continue
+        for insert_file in request.files.getlist(key):
+            if insert_file.filename != '':
+                with timed('save'):
+                    digest = blob_store.add_stream(insert_file.stream, owner=owner)
+                insertions.setdefault(key, []).append(blob_store.path(digest))
+    return insertions
+
+
+def release_insertions(insertions):
+    for paths in insertions.values():
+        blob_store.release_paths(paths)
+
+
+def _session_insert_paths(session_id, file_id):
+    inserts_dir = os.path.join(app.config['EDIT_FOLDER'], session_id, 'inserts')
+    return inserts_dir, os.path.join(inserts_dir, f'{file_id}.pdf'), os.path.join(inserts_dir, f'{file_id}.json')
+
+
+def attach_session_insert(session_id, file_id, owner, image_dpi=None):
+    """Give an edit session its own copy of a chunk-uploaded insert file.
+
+    The upload's blob is hard-linked into the session's ``inserts/`` folder
+    (an image is converted to a PDF there once) and its page count is saved
+    next to it as ``<file_id>.json``, so later edits refer to the file ID
+    without uploading, converting or counting it again. PDFs are pooled
+    under their blob path, so the parsed document is shared with any merge
+    of the same upload. The upload record is released once the session has
+    its copy. Returns the insert's record, or None if neither the session
+    nor ``owner``'s uploads know ``file_id``.
+    """
+    inserts_dir, pdf_path, record_path = _session_insert_paths(session_id, file_id)
+    if os.path.exists(record_path):
+        return _read_manifest(record_path)
+    upload = upload_registry.get(file_id, owner=owner)
+    if upload is None:
+        # Attached by a concurrent request in the meantime?
+        return _read_manifest(record_path) if os.path.exists(record_path) else None
+    
+    os.makedirs(inserts_dir, exist_ok=True)
+    try:
+        if image_format(upload['path']):
+            converted = convert_images([upload['path']], pdf_path, image_dpi)
+            os.replace(converted[upload['path']], pdf_path)
+            key = pdf_path
+        else:
+            with timed('save'):
+                blob_store.link(upload['checksum'], pdf_path)
+            key = upload['path']
+        with timed('parse'), document_pool.borrow(key, pdf_path) as doc:
+            page_count = len(doc)
+    except Exception:
+        document_pool.discard(pdf_path)
+        if os.path.exists(pdf_path):
+            os.remove(pdf_path)
+        raise
+    
+    record = {'file_id': file_id, 'filename': upload['filename'], 'path': pdf_path, 'key': key,
+              'page_count': page_count}
+    tmp_path = f"{record_path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(record, f)
+    os.replace(tmp_path, record_path)
+    upload_registry.remove(file_id)
+    return record
+
+
+def session_inserts(session_id, page_order, image_dpi=None):
+    """Return ``{file_id: record}`` for the uploaded files ``page_order`` refers to.
+
+    Files the session doesn't have yet are attached first (see
+    ``attach_session_insert``). Raises LookupError for a file ID that isn't
+    known.
+    """
+    owner = _upload_owner()
+    inserted_docs = {}
+    for item in page_order:
+        if item.get('type') != 'file' or item['value'] in inserted_docs:
+            continue
+        record = attach_session_insert(session_id, secure_filename(item['value']), owner, image_dpi)
+        if record is None:
+            raise LookupError(f"Inserted file not found: {item['value']}")
+        inserted_docs[item['value']] = record
+    return inserted_docs
+
+
+@app.route('/edit-inserts', methods=['POST'])
+def add_edit_insert():
+    """Attach a chunk-uploaded PDF or image to an edit session for use in page_order"""
+    try:
+        session_id = request.form.get('session_id')
+        file_id = request.form.get('fileId')
+        if not session_id or not file_id:
+            return jsonify({'error': 'Missing session or file ID'}), 400
+        
+        safe_session_id = secure_filename(session_id)
+        if load_session_manifest(safe_session_id) is None:
+            return jsonify({'error': 'Session not found'}), 404
+        
+        record = attach_session_insert(safe_session_id, secure_filename(file_id), _upload_owner(),
+                                       _requested_image_dpi())
+        if record is None:
+            return jsonify({'error': 'Uploaded file not found'}), 404
+        
+        return jsonify({
+            'success': True,
+            'fileId': record['file_id'],
+            'filename': record['filename'],
+            'total_pages': record['page_count']
+        })
+    
+    except Exception as e:
+        print(f"Error in add_edit_insert: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+
 @app.route('/apply-edits', methods=['POST'])
 def apply_edits():
     """Apply page removals, insertions, and reordering, then show success page"""
@@ -438,72 +1778,35 @@ def apply_edits():
         page_order = json.loads(page_order_json)
         
         # Load original PDF
-        pdf_path = os.path.join(app.config['EDIT_FOLDER'], safe_session_id, 'original.pdf')
+        session_dir = os.path.join(app.config['EDIT_FOLDER'], safe_session_id)
+        pdf_path = os.path.join(session_dir, 'original.pdf')
         
-        if not os.path.exists(pdf_path):
+        manifest = load_session_manifest(safe_session_id)
+        if manifest is None:
             return jsonify({'error': 'Session not found'}), 404
-            
-        reader = PdfReader(pdf_path)
-        writer = PdfWriter()
-        
-        # If page order is provided, use it; otherwise use default sequential order
-        if page_order and len(page_order) > 0:
-            # Process pages in the order specified by drag-and-drop
-            for item in page_order:
-                if item['type'] == 'page':
-                    page_num = int(item['value'])
-                    # Skip removed pages
-                    if page_num not in removed_pages:
-                        writer.add_page(reader.pages[page_num - 1])
-                
-                elif item['type'] == 'insert':
-                    insert_key = f"insert_after_{item['value']}"
-                    if insert_key in request.files:
-                        insert_files = request.files.getlist(insert_key)
-                        for insert_file in insert_files:
-                            if insert_file.filename != '':
-                                # Read the inserted PDF
-                                insert_reader = PdfReader(insert_file.stream)
-                                # Add all pages from inserted PDF
-                                for insert_page in insert_reader.pages:
-                                    writer.add_page(insert_page)
-        else:
-            # Fallback to original logic if no page order provided
-            # Collect all insertion keys from the request
-            all_insertion_keys = []
-            for key in request.files.keys():
-                if key.startswith('insert_after_'):
-                    all_insertion_keys.append(key)
-            
-            # Process each page
-            for page_num in range(1, len(reader.pages) + 1):
-                # Skip removed pages
-                if page_num not in removed_pages:
-                    writer.add_page(reader.pages[page_num - 1])
-                
-                # Check for insertions after this page (including nested ones)
-                page_insert_keys = [k for k in all_insertion_keys if k.startswith(f'insert_after_{page_num}')]
-                
-                for insert_key in page_insert_keys:
-                    if insert_key in request.files:
-                        insert_files = request.files.getlist(insert_key)
-                        for insert_file in insert_files:
-                            if insert_file.filename != '':
-                                # Read the inserted PDF
-                                insert_reader = PdfReader(insert_file.stream)
-                                # Add all pages from inserted PDF
-                                for insert_page in insert_reader.pages:
-                                    writer.add_page(insert_page)
+        
+        # Inserted files come from earlier chunked uploads, or with this request
+        try:
+            inserted_docs = session_inserts(safe_session_id, page_order, _requested_image_dpi())
+        except LookupError as e:
+            return jsonify({'error': str(e)}), 404
+        insertions = save_insert_files()
         
         # Save edited PDF
-        output_path = os.path.join(app.config['EDIT_FOLDER'], safe_session_id, 'edited.pdf')
-        with open(output_path, 'wb') as output_file:
-            writer.write(output_file)
+        output_path = os.path.join(session_dir, 'edited.pdf')
+        try:
+            apply_page_edits(pdf_path, output_path, removed_pages, page_order, insertions,
+                             total_pages=manifest['page_count'], image_dpi=_requested_image_dpi(),
+                             inserted_docs=inserted_docs)
+        finally:
+            release_insertions(insertions)
+        optimization = optimize_pdf(output_path, _requested_optimize_level())
         
         # Return success response
         return jsonify({
             'success': True,
-            'session_id': safe_session_id
+            'session_id': safe_session_id,
+            'optimization': optimization
         })
         
     except Exception as e:
@@ -524,21 +1827,103 @@ def download_edited(session_id):
         if not os.path.exists(output_path):
             return "File not found", 404
         
-        response = send_file(output_path, as_attachment=True, download_name='edited.pdf')
+        # The session is removed DOWNLOAD_RETENTION after the last download
+        return send_output(output_path, 'edited.pdf')
+    except Exception as e:
+        print(f"Error downloading edited PDF: {e}")
+        return "Error downloading file", 500
+
+
+def worker_pool(max_workers):
+    """A process pool whose workers are not forked from this process.
+
+    Request threads and thumbnail pre-rendering run alongside the pools; a
+    worker forked while one of them held a lock (the document pool's, the
+    thumbnail cache's or one inside MuPDF) would wait on it forever.
+    Workers start from a forkserver instead, or are spawned where that is
+    unavailable, and import the app afresh. That import only sees the
+    defaults, so each worker is handed the settings in effect when the pool
+    is created (output folders, merge engine, image options and so on).
+    """
+    methods = multiprocessing.get_all_start_methods()
+    context = multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+    return ProcessPoolExecutor(max_workers=max_workers, mp_context=context,
+                               initializer=_init_worker, initargs=(dict(app.config),))
+
+
+def _init_worker(settings):
+    # pdf_core reads app.config too (see use_config), so this covers its settings
+    app.config.update(settings)
+
+
+_split_pool = None
+_split_pool_lock = threading.Lock()
+
+
+def split_executor():
+    """The shared process pool for split parts, created on first use; None when SPLIT_WORKERS is 0"""
+    global _split_pool
+    if not app.config['SPLIT_WORKERS']:
+        return None
+    with _split_pool_lock:
+        if _split_pool is None:
+            _split_pool = worker_pool(app.config['SPLIT_WORKERS'])
+        return _split_pool
+
+
+@app.route('/split', methods=['POST'])
+def split_pages():
+    """Split the session's PDF into parts and stream them back as a ZIP"""
+    try:
+        session_id = request.form.get('session_id')
+        if not session_id:
+            return jsonify({'error': 'No session ID provided'}), 400
+        
+        # Sanitize session_id
+        safe_session_id = secure_filename(session_id)
+        manifest = load_session_manifest(safe_session_id)
+        if manifest is None:
+            return jsonify({'error': 'Session not found'}), 404
         
-        # Clean up session after download
+        mode = request.form.get('mode', 'ranges')
+        toc = ()
+        if mode == 'bookmarks':
+            with borrow_session_document(safe_session_id, manifest) as doc:
+                toc = doc.get_toc(simple=True)
         try:
-            session_dir = os.path.join(app.config['EDIT_FOLDER'], safe_session_id)
-            if os.path.exists(session_dir):
-                import shutil
-                shutil.rmtree(session_dir)
-        except Exception as cleanup_error:
-            print(f"Error cleaning up session: {cleanup_error}")
+            parts = plan_split(mode, request.form.get('value', ''), manifest['page_count'], toc)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        
+        session_dir = os.path.join(app.config['EDIT_FOLDER'], safe_session_id)
+        pdf_path = os.path.join(session_dir, 'original.pdf')
+        work_dir = os.path.join(session_dir, f"split_{uuid.uuid4().hex}")
+        os.makedirs(work_dir)
         
+        def generate():
+            import shutil
+            try:
+                # Parts are produced in parallel; each is sent as soon as the ones before it are
+                for data in stream_zip(split_pdf(pdf_path, parts, work_dir, split_executor())):
+                    if data:
+                        yield data
+            except Exception as e:
+                # Headers are already sent; the truncated archive tells the client it failed
+                print(f"Error streaming split: {e}")
+                raise
+            finally:
+                shutil.rmtree(work_dir, ignore_errors=True)
+        
+        response = Response(stream_with_context(generate()), mimetype='application/zip')
+        response.headers['Content-Disposition'] = 'attachment; filename="split.zip"'
+        response.headers['X-Split-Parts'] = str(len(parts))
         return response
+        
     except Exception as e:
-        print(f"Error downloading edited PDF: {e}")
-        return "Error downloading file", 500
+        print(f"Error splitting PDF: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
 
 
 @app.route('/edit-success', methods=['GET'])
@@ -550,5 +1935,352 @@ def edit_success():
     return render_template('edit_success.html', session_id=session_id)
 
 
+# BACKGROUND JOBS
+
+def _job_status_path(job_id):
+    return os.path.join(app.config['JOBS_FOLDER'], f'{job_id}.json')
+
+
+def write_job_status(job_id, status):
+    """Atomically replace a job's status file so any process can read it"""
+    path = _job_status_path(job_id)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    with open(tmp_path, 'w') as f:
+        json.dump(status, f)
+    os.replace(tmp_path, path)
+
+
+def read_job_status(job_id):
+    try:
+        with open(_job_status_path(job_id)) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def purge_job_statuses():
+    """Remove status files of jobs that finished more than JOB_STATUS_TTL ago"""
+    cutoff = time.time() - app.config['JOB_STATUS_TTL']
+    for entry in os.scandir(app.config['JOBS_FOLDER']):
+        try:
+            if entry.stat().st_mtime < cutoff:
+                os.remove(entry.path)
+        except OSError:
+            pass
+
+
+class JobProgress:
+    """Progress reporter used inside a worker process.
+
+    Writes are throttled so per-page callbacks don't turn into per-page disk
+    writes; the final state is always written.
+    """
+
+    def __init__(self, job_id, kind, interval=0.25):
+        self.job_id = job_id
+        self.status = {'job_id': job_id, 'kind': kind, 'state': 'running', 'progress': {}}
+        self.interval = interval
+        self._last_write = 0
+
+    def update(self, force=False, **progress):
+        self.status['progress'].update(progress)
+        now = time.monotonic()
+        if force or now - self._last_write >= self.interval:
+            write_job_status(self.job_id, self.status)
+            self._last_write = now
+
+    def finish(self, **result):
+        self.status['state'] = 'done'
+        self.status['result'] = result
+        self.update(force=True, percent=100)
+
+    def fail(self, error):
+        self.status['state'] = 'failed'
+        self.status['error'] = error
+        self.update(force=True)
+
+
+def run_merge_job(job_id, file_ids, input_paths, output_filename, optimize_level, image_dpi=None):
+    """Worker-process entry point for a merge job"""
+    progress = JobProgress(job_id, 'merge')
+    progress.update(force=True, inputs_done=0, inputs_total=len(input_paths), pages=0, percent=0)
+    output_path = os.path.join(app.config['MERGED_FOLDER'], output_filename)
+    try:
+        merge_files(
+            input_paths, output_path,
+            progress=lambda done, pages: progress.update(
+                inputs_done=done, pages=pages, percent=int(90 * done / len(input_paths))),
+            image_dpi=image_dpi
+        )
+        optimization = optimize_pdf(output_path, optimize_level)
+        progress.update(bytes_written=os.path.getsize(output_path))
+        progress.finish(filename=output_filename, optimization=optimization)
+    except Exception as e:
+        print(f"Error in merge job {job_id}: {e}")
+        progress.fail(MERGE_ERROR_MESSAGE)
+    finally:
+        for file_id in file_ids:
+            upload_registry.remove(file_id)
+    return metrics.drain()
+
+
+def run_edit_job(job_id, session_id, removed_pages, page_order, insertions, optimize_level, image_dpi=None,
+                 inserted_docs=None):
+    """Worker-process entry point for an apply-edits job"""
+    progress = JobProgress(job_id, 'edit')
+    session_dir = os.path.join(app.config['EDIT_FOLDER'], session_id)
+    pdf_path = os.path.join(session_dir, 'original.pdf')
+    output_path = os.path.join(session_dir, 'edited.pdf')
+    manifest = load_session_manifest(session_id)
+    # Only an estimate: inserted documents can add any number of pages
+    pages_total = max(1, sum(1 for item in page_order if item['type'] == 'page') or (manifest or {}).get('page_count', 0))
+    progress.update(force=True, pages=0, pages_total=pages_total, percent=0)
+    try:
+        apply_page_edits(
+            pdf_path, output_path, removed_pages, page_order, insertions,
+            progress=lambda pages: progress.update(pages=pages, percent=min(90, int(90 * pages / pages_total))),
+            total_pages=manifest['page_count'] if manifest else None,
+            image_dpi=image_dpi,
+            inserted_docs=inserted_docs
+        )
+        optimization = optimize_pdf(output_path, optimize_level)
+        progress.update(bytes_written=os.path.getsize(output_path))
+        progress.finish(session_id=session_id, optimization=optimization)
+    except Exception as e:
+        progress.fail(str(e))
+    finally:
+        release_insertions(insertions)
+    return metrics.drain()
+
+
+class JobQueue:
+    """Bounded queue of merge/edit jobs executed in a process pool.
+
+    The pool is created on first use. ``submit`` returns None instead of
+    queueing when ``limit`` jobs are already queued or running, so callers can
+    shed load rather than pile work up in memory.
+    """
+
+    def __init__(self, max_workers, limit):
+        self.max_workers = max_workers
+        self.limit = limit
+        self._executor = None
+        self._active = set()
+        self._lock = threading.Lock()
+
+    def is_full(self):
+        with self._lock:
+            return len(self._active) >= self.limit
+
+    def active_count(self):
+        with self._lock:
+            return len(self._active)
+
+    def submit(self, kind, fn, *args):
+        purge_job_statuses()
+        purge_expired_outputs_soon()
+        with self._lock:
+            if len(self._active) >= self.limit:
+                return None
+            if self._executor is None:
+                self._executor = worker_pool(self.max_workers)
+            job_id = uuid.uuid4().hex
+            write_job_status(job_id, {'job_id': job_id, 'kind': kind, 'state': 'queued', 'progress': {}})
+            future = self._executor.submit(fn, job_id, *args)
+            self._active.add(job_id)
+        future.add_done_callback(lambda f: self._on_done(job_id, kind, f))
+        return job_id
+
+    def _on_done(self, job_id, kind, future):
+        with self._lock:
+            self._active.discard(job_id)
+        error = future.exception()
+        if error is not None:
+            # The worker died before it could record the failure itself
+            write_job_status(job_id, {'job_id': job_id, 'kind': kind, 'state': 'failed',
+                                      'progress': {}, 'error': str(error)})
+        elif future.result():
+            # Samples recorded in the worker process since its last job
+            metrics.merge(future.result())
+
+
+job_queue = JobQueue(app.config['JOB_WORKERS'], app.config['JOB_QUEUE_LIMIT'])
+
+
+def _queue_full_response():
+    response = jsonify({'error': 'Server is busy, please try again shortly'})
+    response.status_code = 503
+    response.headers['Retry-After'] = str(app.config['JOB_RETRY_AFTER'])
+    return response
+
+
+@app.route('/jobs/merge', methods=['POST'])
+def submit_merge_job():
+    """Queue a merge of chunk-uploaded files and return its job ID"""
+    try:
+        file_ids = request.form.getlist('fileIds[]')
+        
+        if not file_ids:
+            return jsonify({'error': 'No files provided'}), 400
+        
+        owner = _upload_owner()
+        records = [upload_registry.get(secure_filename(file_id), owner=owner) for file_id in file_ids]
+        records = [record for record in records if record]
+        
+        if not records:
+            return jsonify({'error': 'No uploaded files found'}), 404
+        
+        job_id = job_queue.submit(
+            'merge', run_merge_job,
+            [record['file_id'] for record in records],
+            [record['path'] for record in records],
+            f"merged_{uuid.uuid4().hex}.pdf",
+            _requested_optimize_level(),
+            _requested_image_dpi()
+        )
+        if job_id is None:
+            return _queue_full_response()
+        
+        return jsonify({'success': True, 'job_id': job_id}), 202
+    
+    except Exception as e:
+        print(f"Error in submit_merge_job: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': f'An error occurred: {str(e)}'}), 500
+
+
+@app.route('/jobs/apply-edits', methods=['POST'])
+def submit_edit_job():
+    """Queue an apply-edits run for a session and return its job ID"""
+    try:
+        session_id = request.form.get('session_id')
+        if not session_id:
+            return jsonify({'error': 'No session ID provided'}), 400
+        
+        safe_session_id = secure_filename(session_id)
+        session_dir = os.path.join(app.config['EDIT_FOLDER'], safe_session_id)
+        
+        if not os.path.exists(os.path.join(session_dir, 'original.pdf')):
+            return jsonify({'error': 'Session not found'}), 404
+        
+        removed_pages = set(json.loads(request.form.get('removed_pages', '[]')))
+        page_order = json.loads(request.form.get('page_order', '[]'))
+        
+        # Check capacity before saving any inserted files
+        if job_queue.is_full():
+            return _queue_full_response()
+        
+        try:
+            inserted_docs = session_inserts(safe_session_id, page_order, _requested_image_dpi())
+        except LookupError as e:
+            return jsonify({'error': str(e)}), 404
+        insertions = save_insert_files()
+        job_id = job_queue.submit('edit', run_edit_job, safe_session_id, removed_pages, page_order,
+                                  insertions, _requested_optimize_level(), _requested_image_dpi(), inserted_docs)
+        if job_id is None:
+            release_insertions(insertions)
+            return _queue_full_response()
+        
+        return jsonify({'success': True, 'job_id': job_id}), 202
+    
+    except Exception as e:
+        print(f"Error in submit_edit_job: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+
+@app.route('/jobs/<job_id>', methods=['GET'])
+def job_status(job_id):
+    """Return the current state and progress of a job"""
+    status = read_job_status(secure_filename(job_id))
+    if status is None:
+        return jsonify({'error': 'Job not found'}), 404
+    return jsonify(status)
+
+
+@app.route('/jobs/<job_id>/events', methods=['GET'])
+def job_events(job_id):
+    """Stream job status changes as Server-Sent Events until the job ends"""
+    safe_job_id = secure_filename(job_id)
+    if read_job_status(safe_job_id) is None:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    def generate():
+        last_sent = None
+        while True:
+            status = read_job_status(safe_job_id)
+            if status is None:
+                return
+            payload = json.dumps(status)
+            if payload != last_sent:
+                yield f"data: {payload}\n\n"
+                last_sent = payload
+            if status['state'] in ('done', 'failed'):
+                return
+            time.sleep(0.25)
+    
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+# METRICS
+
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """Expose request and processing metrics in Prometheus text format"""
+    if not app.config['METRICS_ENABLED']:
+        return "Metrics are disabled", 404
+    gauges = [
+        ('pdf_document_pool_handles', 'Open documents in the edit session pool', len(document_pool)),
+        ('pdf_thumbnail_cache_bytes', 'Bytes of thumbnails tracked by the cache', thumbnail_cache.total_bytes()),
+        ('pdf_jobs_active', 'Queued or running background jobs', job_queue.active_count()),
+    ]
+    peak_rss = peak_rss_bytes()
+    if peak_rss is not None:
+        gauges.append(('process_peak_rss_bytes', 'Peak resident set size of this process', peak_rss))
+    return Response(metrics.render(gauges), mimetype='text/plain; version=0.0.4')
+
+
+# WARM-UP
+
+def warm_up():
+    """Preload the PDF libraries and compile the templates.
+
+    Returns the seconds each step took. Called from a background thread at
+    startup when WARM_UP is set, and by GET /warm-up for platform warmers.
+    """
+    timings = {}
+    start = time.perf_counter()
+    load_pdf_libraries()
+    webp_supported()
+    renderer_version()
+    timings['pdf_libraries'] = round(time.perf_counter() - start, 6)
+    start = time.perf_counter()
+    for name in app.jinja_env.list_templates():
+        app.jinja_env.get_template(name)
+    timings['templates'] = round(time.perf_counter() - start, 6)
+    return timings
+
+
+@app.route('/warm-up', methods=['GET'])
+def warm_up_endpoint():
+    """Load heavy libraries ahead of real traffic"""
+    try:
+        return jsonify({'success': True, 'timings': warm_up()})
+    except Exception as e:
+        print(f"Error in warm_up: {e}")
+        import traceback
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
+
+if app.config['WARM_UP']:
+    threading.Thread(target=warm_up, name='warm-up', daemon=True).start()
+
+
 if __name__ == '__main__':
     app.run(debug=True)
@@ -0,0 +1,223 @@
+"""Merge PDF bundles listed in a manifest, in parallel, without the web app.
+
+    python api/pdf_batch.py bundles.csv --workers 8 --report failures.json
+
+A CSV manifest has ``output`` and ``input`` columns with one input per row;
+rows with the same output are merged in the order they appear. A JSON
+manifest maps each output to its list of inputs, or is a list of
+``{"output": ..., "inputs": [...]}`` objects. Relative paths are resolved
+against the manifest's directory.
+
+Inputs may be PDFs or JPEG, PNG and TIFF images, which become one page per
+image or TIFF frame. Bundles run in a process pool using the same merge
+engines as the web app (``pdf_core``). Each finished bundle is written to stdout as one JSON line.
+Inputs that are missing or can't be opened are skipped and reported while
+the rest of the bundle is still merged; ``--strict`` fails the bundle
+instead. The exit status is 1 if any bundle failed or skipped an input.
+
+The same steps are available from Python::
+
+    import pdf_batch
+    for result in pdf_batch.run_batch(pdf_batch.load_manifest('bundles.csv'), workers=8):
+        ...
+"""
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import time
+import uuid
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+
+from pdf_core import MERGE_ENGINES, OPTIMIZE_LEVELS, image_format, load_pdf_libraries, merge_files, optimize_pdf
+
+
+def load_manifest(path):
+    """Read a CSV or JSON manifest into a list of ``(output_path, [input_paths])``"""
+    base_dir = os.path.dirname(os.path.abspath(path))
+
+    def resolve(name):
+        return os.path.normpath(os.path.join(base_dir, os.path.expanduser(name)))
+
+    bundles = {}  # Ordered by first appearance of each output
+    if path.endswith('.json'):
+        with open(path) as f:
+            data = json.load(f)
+        entries = data.items() if isinstance(data, dict) else ((entry['output'], entry['inputs']) for entry in data)
+        for output, inputs in entries:
+            bundles.setdefault(resolve(output), []).extend(resolve(name) for name in inputs)
+    else:
+        with open(path, newline='') as f:
+            for line, row in enumerate(csv.DictReader(f), start=2):
+                if not row.get('output') or not row.get('input'):
+                    raise ValueError(f'{path}:{line}: expected "output" and "input" columns')
+                bundles.setdefault(resolve(row['output']), []).append(resolve(row['input']))
+    return list(bundles.items())
+
+
+def _unreadable_inputs(input_paths):
+    """Return ``{path: error}`` for inputs that are neither a PDF with pages nor an image Pillow can read"""
+    import fitz  # PyMuPDF
+    from PIL import Image
+    errors = {}
+    for path in dict.fromkeys(input_paths):
+        if not os.path.isfile(path):
+            errors[path] = 'file not found'
+            continue
+        try:
+            if image_format(path):
+                with Image.open(path) as img:
+                    img.verify()
+                continue
+            with fitz.open(path, filetype='pdf') as doc:
+                if len(doc) == 0:
+                    errors[path] = 'no pages'
+        except Exception as e:
+            errors[path] = str(e) or type(e).__name__
+    return errors
+
+
+def merge_bundle(output_path, input_paths, engine_name=None, optimize_level=0, strict=False, image_dpi=None):
+    """Merge one bundle and return a result dict; never raises.
+
+    ``status`` is ``ok``, ``partial`` (merged without the inputs listed in
+    ``skipped``) or ``failed`` (see ``error``). The output is written to a
+    temporary file first, so an existing output is never left half-written.
+    """
+    start = time.perf_counter()
+    result = {'output': output_path, 'inputs': len(input_paths), 'status': 'ok', 'skipped': []}
+    tmp_path = f"{output_path}.{uuid.uuid4().hex}.tmp"
+    written = {'pages': 0}
+
+    def merge(paths):
+        def progress(done, pages):
+            written['pages'] = pages
+        result['engine'] = merge_files(paths, tmp_path, engine_name, progress=progress, image_dpi=image_dpi)
+
+    try:
+        os.makedirs(os.path.dirname(output_path) or '.', exist_ok=True)
+        try:
+            if not all(os.path.isfile(path) for path in input_paths):
+                raise FileNotFoundError('missing input')
+            merge(input_paths)
+        except Exception:
+            # Find the inputs to blame, then merge what is left
+            bad = _unreadable_inputs(input_paths)
+            if not bad:
+                raise
+            result['skipped'] = [{'input': path, 'error': error} for path, error in bad.items()]
+            usable = [path for path in input_paths if path not in bad]
+            if strict or not usable:
+                raise ValueError(f'{len(bad)} of {len(set(input_paths))} inputs could not be read')
+            result['status'] = 'partial'
+            merge(usable)
+        result['optimization'] = optimize_pdf(tmp_path, optimize_level)
+        os.replace(tmp_path, output_path)
+        result['pages'] = written['pages']
+        result['bytes'] = os.path.getsize(output_path)
+    except Exception as e:
+        result['status'] = 'failed'
+        result['error'] = str(e) or type(e).__name__
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    result['seconds'] = round(time.perf_counter() - start, 6)
+    return result
+
+
+def _init_worker():
+    # Inherited with fork, but not with spawn
+    sys.stdout = sys.stderr
+    load_pdf_libraries()
+
+
+def run_batch(bundles, workers=None, engine_name=None, optimize_level=0, strict=False, skip_existing=False,
+              image_dpi=None):
+    """Merge ``(output_path, [input_paths])`` bundles and yield results as they finish.
+
+    Bundles run in ``workers`` processes (default: one per CPU), with a
+    bounded number queued at a time so very large manifests don't pile up in
+    memory. ``workers=1`` runs everything in this process.
+    """
+    workers = workers or os.cpu_count() or 1
+    pending_bundles = iter(bundles)
+
+    def next_bundle():
+        for output_path, input_paths in pending_bundles:
+            if skip_existing and os.path.exists(output_path):
+                return output_path, None
+            return output_path, input_paths
+        return None
+
+    if workers == 1:
+        while (bundle := next_bundle()) is not None:
+            output_path, input_paths = bundle
+            if input_paths is None:
+                yield {'output': output_path, 'status': 'exists'}
+            else:
+                yield merge_bundle(output_path, input_paths, engine_name, optimize_level, strict, image_dpi)
+        return
+
+    # Loading the libraries before the pool forks lets every worker share them
+    load_pdf_libraries()
+    context = multiprocessing.get_context('fork' if 'fork' in multiprocessing.get_all_start_methods() else None)
+    with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=_init_worker) as pool:
+        futures = set()
+        exhausted = False
+        while futures or not exhausted:
+            while not exhausted and len(futures) < workers * 4:
+                bundle = next_bundle()
+                if bundle is None:
+                    exhausted = True
+                elif bundle[1] is None:
+                    yield {'output': bundle[0], 'status': 'exists'}
+                else:
+                    futures.add(pool.submit(merge_bundle, *bundle, engine_name, optimize_level, strict, image_dpi))
+            if futures:
+                done, futures = wait(futures, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Merge PDF bundles listed in a CSV or JSON manifest.')
+    parser.add_argument('manifest', help='CSV with output,input columns or JSON mapping outputs to inputs')
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1, help='Worker processes (default: CPU count)')
+    parser.add_argument('--engine', choices=sorted(MERGE_ENGINES), help='Preferred merge engine (default: as configured)')
+    parser.add_argument('--optimize', type=int, choices=[0] + sorted(OPTIMIZE_LEVELS), default=0,
+                        help='Output optimization level')
+    parser.add_argument('--image-dpi', type=int, help='Downscale image inputs above this resolution (default: as configured)')
+    parser.add_argument('--strict', action='store_true', help='Fail a bundle instead of skipping unreadable inputs')
+    parser.add_argument('--skip-existing', action='store_true', help="Leave outputs that already exist alone")
+    parser.add_argument('--report', help='Write failed and partial bundles to this JSON file')
+    args = parser.parse_args(argv)
+
+    bundles = load_manifest(args.manifest)
+    start = time.perf_counter()
+    counts = {}
+    failures = []
+    # Library and engine diagnostics go to stderr so stdout stays one JSON line per bundle
+    results_out, sys.stdout = sys.stdout, sys.stderr
+    try:
+        for done, result in enumerate(run_batch(bundles, args.workers, args.engine, args.optimize,
+                                                args.strict, args.skip_existing, args.image_dpi), start=1):
+            counts[result['status']] = counts.get(result['status'], 0) + 1
+            if result['status'] in ('failed', 'partial'):
+                failures.append(result)
+            print(json.dumps(dict(result, done=done, total=len(bundles))), file=results_out, flush=True)
+    finally:
+        sys.stdout = results_out
+
+    elapsed = time.perf_counter() - start
+    summary = ', '.join(f'{count} {status}' for status, count in sorted(counts.items()))
+    print(f'{len(bundles)} bundles in {elapsed:.1f}s ({len(bundles) / elapsed if elapsed else 0:.1f}/s): {summary}',
+          file=sys.stderr)
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump({'bundles': len(bundles), 'counts': counts, 'failures': failures}, f, indent=2)
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
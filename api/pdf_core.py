@@ -0,0 +1,1071 @@
+"""PDF merge, edit and optimization core shared by the web app and the batch CLI.
+
+Nothing here depends on Flask. Settings live in ``config``; the web app
+points it at ``app.config`` with ``use_config`` so both read the same values.
+PyPDF2, PyMuPDF (fitz) and Pillow are imported where they are used.
+"""
+import io
+import os
+import re
+import sys
+import threading
+import time
+import uuid
+import warnings
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+
+try:
+    import resource
+except ImportError:  # Not available on Windows
+    resource = None
+
+# Suppress PyPDF2 warnings about malformed PDFs
+warnings.filterwarnings("ignore", category=UserWarning, module="PyPDF2")
+
+config = {
+    # Open PyMuPDF documents are reused across requests and merges
+    'DOC_POOL_MAX_HANDLES': 16,
+    'DOC_POOL_MAX_BYTES': 512 * 1024 * 1024,  # Estimated from source file sizes
+    'DOC_POOL_IDLE_TTL': 300,  # Seconds
+    # Merge backend: 'fitz' (PyMuPDF, C-backed), 'fitz-streaming' or 'pypdf2'; the others are fallbacks
+    'MERGE_ENGINE': 'fitz',
+    # Above this total input size merges append to the output in bounded batches,
+    # so peak memory depends on the batch rather than on all inputs together
+    'MERGE_STREAMING_THRESHOLD': 128 * 1024 * 1024,
+    'MERGE_BATCH_BYTES': 64 * 1024 * 1024,
+    'MERGE_BATCH_FILES': 32,
+    # Phase timings and page/byte counters, exposed by the web app on /metrics
+    'METRICS_ENABLED': os.environ.get('METRICS_ENABLED', '1') != '0',
+    # Largest number of parts a single split may produce
+    'SPLIT_MAX_PARTS': 1000,
+    # Parts handed to a split worker at a time; each batch parses the source once
+    'SPLIT_BATCH_PARTS': 8,
+    # JPEG, PNG and TIFF inputs become one page per image (or TIFF frame)
+    'IMAGE_WORKERS': os.cpu_count() or 1,
+    'IMAGE_TARGET_DPI': 0,  # Downscale images sharper than this; 0 keeps every pixel
+    'IMAGE_DEFAULT_DPI': 96,  # For images that don't record a resolution
+    'IMAGE_MAX_PAGE_POINTS': 842,  # Longest page edge (A4); larger images are shrunk to fit
+    'IMAGE_JPEG_QUALITY': 85,  # Only used when a JPEG has to be re-encoded
+}
+
+
+def use_config(mapping):
+    """Read settings from ``mapping`` (e.g. a Flask ``app.config``) from now on.
+
+    Keys it doesn't define are filled in with the defaults above.
+    """
+    global config
+    for key, value in config.items():
+        mapping.setdefault(key, value)
+    config = mapping
+
+
+# INSTRUMENTATION
+
+class Metrics:
+    """In-process counters and histograms rendered in Prometheus text format.
+
+    Series are keyed by metric name and label values. Job worker processes
+    record into their own copy and hand their samples back with the job
+    result (see ``drain`` and ``merge``), so /metrics covers them too.
+    """
+
+    BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+    HELP = {
+        'pdf_http_request_duration_seconds': 'Time from request start until the response body was sent',
+        'pdf_http_request_bytes_total': 'Request body bytes received',
+        'pdf_http_response_bytes_total': 'Response body bytes sent',
+        'pdf_phase_duration_seconds': 'Time spent in each processing phase',
+        'pdf_pages_total': 'Pages produced by merges and edits or rendered as previews',
+        'pdf_output_bytes_total': 'Bytes of PDF output written',
+    }
+
+    def __init__(self):
+        self._counters = {}  # (name, labels) -> value
+        self._histograms = {}  # (name, labels) -> [per-bucket counts..., sum, count]
+        self._lock = threading.Lock()
+
+    def inc(self, name, amount=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            series = self._histograms.get(key)
+            if series is None:
+                series = self._histograms[key] = [0] * (len(self.BUCKETS) + 2)
+            for i, bound in enumerate(self.BUCKETS):
+                if value <= bound:
+                    series[i] += 1
+                    break
+            series[-2] += value
+            series[-1] += 1
+
+    def reset(self):
+        """Start from empty, e.g. in a forked worker whose lock may be held"""
+        self._counters = {}
+        self._histograms = {}
+        self._lock = threading.Lock()
+
+    def drain(self):
+        """Return all samples as a picklable dict and reset them"""
+        with self._lock:
+            samples = {'counters': list(self._counters.items()), 'histograms': list(self._histograms.items())}
+            self._counters = {}
+            self._histograms = {}
+        return samples
+
+    def merge(self, samples):
+        """Add samples returned by ``drain`` in another process"""
+        with self._lock:
+            for key, value in samples['counters']:
+                self._counters[key] = self._counters.get(key, 0) + value
+            for key, values in samples['histograms']:
+                series = self._histograms.setdefault(key, [0] * (len(self.BUCKETS) + 2))
+                for i, value in enumerate(values):
+                    series[i] += value
+
+    def render(self, gauges=()):
+        """Return the Prometheus text exposition of all series plus ``gauges``.
+
+        ``gauges`` is an iterable of ``(name, help, value)`` tuples.
+        """
+        with self._lock:
+            counters = sorted(self._counters.items())
+            histograms = sorted((key, list(series)) for key, series in self._histograms.items())
+        lines = []
+        declared = set()
+
+        def declare(name, kind):
+            if name not in declared:
+                declared.add(name)
+                lines.append(f"# HELP {name} {self.HELP.get(name, name)}")
+                lines.append(f"# TYPE {name} {kind}")
+
+        for (name, labels), value in counters:
+            declare(name, 'counter')
+            lines.append(f"{name}{self._labels(labels)} {value}")
+        for (name, labels), series in histograms:
+            declare(name, 'histogram')
+            cumulative = 0
+            for bound, count in zip(self.BUCKETS, series):
+                cumulative += count
+                lines.append(f"{name}_bucket{self._labels(labels + (('le', bound),))} {cumulative}")
+            lines.append(f"{name}_bucket{self._labels(labels + (('le', '+Inf'),))} {series[-1]}")
+            lines.append(f"{name}_sum{self._labels(labels)} {series[-2]}")
+            lines.append(f"{name}_count{self._labels(labels)} {series[-1]}")
+        for name, help_text, value in gauges:
+            lines.append(f"# HELP {name} {help_text}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {value}")
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def _labels(labels):
+        if not labels:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+        return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+metrics = Metrics()
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=metrics.reset)
+
+
+# Called as listener(phase, seconds) after every timed phase
+phase_listeners = []
+
+
+@contextmanager
+def timed(phase):
+    """Record the time spent in a processing phase (save, parse, merge, ...)"""
+    if not config['METRICS_ENABLED']:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        metrics.observe('pdf_phase_duration_seconds', elapsed, phase=phase)
+        for listener in phase_listeners:
+            listener(phase, elapsed)
+
+
+def count_output(operation, pages, path=None):
+    """Record the pages (and optionally the file size) an operation produced"""
+    if config['METRICS_ENABLED']:
+        metrics.inc('pdf_pages_total', pages, operation=operation)
+        if path:
+            metrics.inc('pdf_output_bytes_total', os.path.getsize(path), operation=operation)
+
+
+def peak_rss_bytes():
+    """Peak resident set size of this process, or None where unsupported"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+# PDF DOCUMENT POOL
+
+class _PooledDocument:
+    def __init__(self, doc, size):
+        self.doc = doc
+        self.size = size
+        self.lock = threading.Lock()  # fitz documents are not safe for concurrent use
+        self.users = 0
+        self.retired = False
+        self.last_used = time.monotonic()
+
+
+class DocumentPool:
+    """Process-wide pool of open fitz documents keyed by content or file path.
+
+    Reusing a handle avoids re-parsing the xref and page tree on every
+    thumbnail request. Handles are closed after ``idle_ttl`` seconds without
+    use, or least recently used first once ``max_handles`` or ``max_bytes``
+    (estimated from file size) is exceeded. A handle evicted while borrowed
+    is closed when its last borrower releases it.
+    """
+
+    def __init__(self, max_handles, max_bytes, idle_ttl):
+        self.max_handles = max_handles
+        self.max_bytes = max_bytes
+        self.idle_ttl = idle_ttl
+        self._entries = OrderedDict()  # key -> _PooledDocument
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            return len(self._entries)
+
+    @contextmanager
+    def borrow(self, key, pdf_path):
+        """Yield the open document for ``key``, holding it exclusively"""
+        entry = self._acquire(key, pdf_path)
+        try:
+            with entry.lock:
+                yield entry.doc
+        finally:
+            self._release(entry)
+
+    def reset(self):
+        """Forget every handle without closing it.
+
+        Used in forked worker processes: the inherited documents share file
+        offsets with the parent, so the child must open its own.
+        """
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def discard(self, key):
+        """Close the handle for ``key``, e.g. before its files are removed"""
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            to_close = self._retire(entry) if entry else []
+        self._close(to_close)
+
+    def _acquire(self, key, pdf_path):
+        with self._lock:
+            to_close = self._expire_idle()
+            entry = self._entries.get(key)
+            if entry:
+                entry.users += 1
+                self._entries.move_to_end(key)
+        self._close(to_close)
+        if entry:
+            return entry
+
+        # Open outside the pool lock so large files don't block other sessions
+        import fitz  # PyMuPDF
+        doc = fitz.open(pdf_path, filetype='pdf')
+        new_entry = _PooledDocument(doc, os.path.getsize(pdf_path))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry:
+                # Another request opened it first; use theirs
+                to_close = [new_entry]
+            else:
+                entry = new_entry
+                self._entries[key] = entry
+                to_close = self._evict_over_limit(keep=key)
+            entry.users += 1
+        self._close(to_close)
+        return entry
+
+    def _release(self, entry):
+        with self._lock:
+            entry.users -= 1
+            entry.last_used = time.monotonic()
+            close_now = entry.retired and entry.users == 0
+        if close_now:
+            entry.doc.close()
+
+    def _expire_idle(self):
+        now = time.monotonic()
+        expired = [k for k, e in self._entries.items()
+                   if e.users == 0 and now - e.last_used > self.idle_ttl]
+        to_close = []
+        for key in expired:
+            to_close.extend(self._retire(self._entries.pop(key)))
+        return to_close
+
+    def _evict_over_limit(self, keep):
+        to_close = []
+        total_bytes = sum(e.size for e in self._entries.values())
+        for key in list(self._entries):
+            if len(self._entries) <= self.max_handles and total_bytes <= self.max_bytes:
+                break
+            if key == keep:
+                continue
+            entry = self._entries.pop(key)
+            total_bytes -= entry.size
+            to_close.extend(self._retire(entry))
+        return to_close
+
+    @staticmethod
+    def _retire(entry):
+        # Must be called with the pool lock held; returns entries safe to close
+        entry.retired = True
+        return [entry] if entry.users == 0 else []
+
+    @staticmethod
+    def _close(entries):
+        for entry in entries:
+            try:
+                entry.doc.close()
+            except Exception:
+                pass
+
+
+document_pool = DocumentPool(
+    config['DOC_POOL_MAX_HANDLES'],
+    config['DOC_POOL_MAX_BYTES'],
+    config['DOC_POOL_IDLE_TTL']
+)
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=document_pool.reset)
+
+
+# MERGE ENGINES
+
+class MergeEngine:
+    """Writes the pages of several PDFs, in order, into one output file.
+
+    ``progress``, if given, is called as ``progress(inputs_done, pages)``
+    after each input has been added. Returns the output page count.
+    ``bounded_memory`` engines keep peak memory independent of the number
+    and total size of the inputs.
+    """
+    name = None
+    bounded_memory = False
+
+    def merge(self, input_paths, output_path, progress=None):
+        raise NotImplementedError
+
+
+class PyPDF2MergeEngine(MergeEngine):
+    name = 'pypdf2'
+
+    def merge(self, input_paths, output_path, progress=None):
+        from PyPDF2 import PdfMerger, PdfReader
+        merger = PdfMerger()
+        readers = {}  # Parse a file used in several slots only once
+        try:
+            for idx, path in enumerate(input_paths, 1):
+                with timed('merge'):
+                    if path not in readers:
+                        readers[path] = PdfReader(path)
+                    merger.append(readers[path])
+                if progress:
+                    progress(idx, len(merger.pages))
+            with timed('write'):
+                merger.write(output_path)
+            return len(merger.pages)
+        finally:
+            merger.close()
+
+
+class FitzMergeEngine(MergeEngine):
+    """PyMuPDF merge that borrows its inputs from the document pool.
+
+    A file repeated within a merge, or used again by a later merge, is
+    parsed only once.
+    """
+    name = 'fitz'
+
+    def merge(self, input_paths, output_path, progress=None):
+        import fitz  # PyMuPDF
+        output = fitz.open()
+        toc = []
+        try:
+            for idx, path in enumerate(input_paths, 1):
+                with timed('merge'), document_pool.borrow(path, path) as src:
+                    # Keep bookmarks like PdfMerger does, shifted to their new position
+                    offset = len(output)
+                    toc.extend([level, title, page + offset] + rest
+                               for level, title, page, *rest in src.get_toc(simple=False))
+                    output.insert_pdf(src)
+                if progress:
+                    progress(idx, len(output))
+            if toc:
+                output.set_toc(toc)
+            with timed('write'):
+                output.save(output_path)
+            return len(output)
+        finally:
+            output.close()
+
+
+class StreamingMergeEngine(MergeEngine):
+    """PyMuPDF merge that appends inputs to the output file batch by batch.
+
+    Each batch of at most MERGE_BATCH_FILES inputs / MERGE_BATCH_BYTES is
+    inserted into the output, written with an incremental save and the
+    document closed again, so sources and copied objects are released after
+    every batch instead of being held until the end.
+    """
+    name = 'fitz-streaming'
+    bounded_memory = True
+
+    def merge(self, input_paths, output_path, progress=None):
+        import fitz  # PyMuPDF
+        toc = []
+        page_count = 0
+        done = 0
+        for batch_index, batch in enumerate(self._batches(input_paths)):
+            output = fitz.open() if batch_index == 0 else fitz.open(output_path)
+            try:
+                for path in batch:
+                    with timed('merge'), fitz.open(path, filetype='pdf') as src:
+                        toc.extend([level, title, page + page_count] + rest
+                                   for level, title, page, *rest in src.get_toc(simple=False))
+                        output.insert_pdf(src)
+                    page_count = len(output)
+                    done += 1
+                    if progress:
+                        progress(done, page_count)
+                self._save(output, output_path, first=(batch_index == 0))
+            finally:
+                output.close()
+        if toc:
+            with fitz.open(output_path) as output:
+                output.set_toc(toc)
+                self._save(output, output_path, first=False)
+        return page_count
+
+    @staticmethod
+    def _batches(input_paths):
+        max_files = config['MERGE_BATCH_FILES']
+        max_bytes = config['MERGE_BATCH_BYTES']
+        batch, batch_bytes = [], 0
+        for path in input_paths:
+            size = os.path.getsize(path)
+            if batch and (len(batch) >= max_files or batch_bytes + size > max_bytes):
+                yield batch
+                batch, batch_bytes = [], 0
+            batch.append(path)
+            batch_bytes += size
+        if batch:
+            yield batch
+
+    @staticmethod
+    @timed('write')
+    def _save(output, output_path, first):
+        if first:
+            output.save(output_path)
+        elif output.can_save_incrementally():
+            import fitz  # PyMuPDF
+            output.save(output_path, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
+        else:
+            # Repaired documents can't be appended to; rewrite them in full
+            tmp_path = f"{output_path}.{uuid.uuid4().hex}.tmp"
+            output.save(tmp_path)
+            os.replace(tmp_path, output_path)
+
+
+MERGE_ENGINES = {engine.name: engine for engine in (FitzMergeEngine(), StreamingMergeEngine(), PyPDF2MergeEngine())}
+
+
+def merge_files(input_paths, output_path, engine_name=None, progress=None, image_dpi=None):
+    """Merge PDFs with the configured engine, retrying with the other engines on failure.
+
+    When the engine is a bounded-memory one (``fitz-streaming``, also chosen
+    automatically above MERGE_STREAMING_THRESHOLD), only other bounded
+    engines are tried, so a failure never turns into an unbounded merge of
+    the same inputs. Image inputs are converted to PDF pages first (see ``convert_images``;
+    ``image_dpi`` overrides IMAGE_TARGET_DPI). Returns the name of the engine
+    that produced the output. If every engine fails, the error from the
+    preferred engine is raised.
+    """
+    images = [path for path in input_paths if image_format(path)]
+    converted = convert_images(images, output_path, image_dpi) if images else {}
+    try:
+        return _merge_with_fallback([converted.get(path, path) for path in input_paths],
+                                    output_path, engine_name, progress)
+    finally:
+        remove_converted(converted)
+
+
+def _merge_with_fallback(input_paths, output_path, engine_name, progress):
+    if engine_name is None:
+        engine_name = config['MERGE_ENGINE']
+        total_bytes = sum(os.path.getsize(path) for path in input_paths)
+        if engine_name == 'fitz' and total_bytes > config['MERGE_STREAMING_THRESHOLD']:
+            engine_name = 'fitz-streaming'
+    preferred = MERGE_ENGINES[engine_name]
+    engines = [preferred] + [e for e in MERGE_ENGINES.values()
+                             if e is not preferred and (e.bounded_memory or not preferred.bounded_memory)]
+    first_error = None
+    for engine in engines:
+        try:
+            pages = engine.merge(input_paths, output_path, progress=progress)
+            count_output('merge', pages, output_path)
+            return engine.name
+        except Exception as e:
+            print(f"Merge engine {engine.name} failed: {e}")
+            first_error = first_error or e
+            if os.path.exists(output_path):
+                os.remove(output_path)
+    if len(engines) < len(MERGE_ENGINES):
+        print(f"Not retrying with in-memory engines: {preferred.name} was chosen to keep memory bounded")
+    raise first_error
+
+
+# IMAGE INPUTS
+
+# Leading bytes -> image format accepted as a merge or insert input
+IMAGE_SIGNATURES = {
+    b'\xff\xd8\xff': 'jpeg',
+    b'\x89PNG\r\n\x1a\n': 'png',
+    b'II*\x00': 'tiff',
+    b'MM\x00*': 'tiff',
+}
+
+# EXIF orientation -> counter-clockwise page rotation that displays the stored pixels upright
+_EXIF_ROTATIONS = {1: 0, 3: 180, 6: -90, 8: 90}
+# EXIF orientation -> Image.transpose() method (Image.Transpose values) for decoded images
+_EXIF_TRANSPOSES = {2: 0, 3: 3, 4: 1, 5: 5, 6: 4, 7: 6, 8: 2}
+
+
+def image_format(path):
+    """Return 'jpeg', 'png' or 'tiff' for a supported image file, else None (e.g. for PDFs)"""
+    with open(path, 'rb') as f:
+        head = f.read(8)
+    for signature, fmt in IMAGE_SIGNATURES.items():
+        if head.startswith(signature):
+            return fmt
+    return None
+
+
+def _image_page_size(img, target_dpi):
+    """Return ``(page_width, page_height, pixel_size)`` in points for one image or frame.
+
+    Pages take the size the image's resolution implies, shrunk to fit
+    IMAGE_MAX_PAGE_POINTS. ``pixel_size`` is the size to downscale to when
+    that leaves more than ``target_dpi`` pixels per inch, otherwise None.
+    """
+    dpi_x, dpi_y = (float(value) for value in img.info.get('dpi') or (0, 0))  # TIFF stores rationals
+    if dpi_x < 10 or dpi_y < 10:  # Missing, or an aspect ratio rather than a resolution
+        dpi_x = dpi_y = config['IMAGE_DEFAULT_DPI']
+    width, height = img.size[0] * 72 / dpi_x, img.size[1] * 72 / dpi_y
+    fit = min(1, config['IMAGE_MAX_PAGE_POINTS'] / max(width, height))
+    width, height = width * fit, height * fit
+    pixel_size = None
+    if target_dpi:
+        target = (max(1, round(width / 72 * target_dpi)), max(1, round(height / 72 * target_dpi)))
+        if target[0] < img.size[0] and target[1] < img.size[1]:
+            pixel_size = target
+    return width, height, pixel_size
+
+
+def _encode_frame(img, lossy):
+    """Encode a decoded frame for embedding: JPEG if it came from one, otherwise lossless PNG"""
+    data = io.BytesIO()
+    if lossy:
+        img.convert(img.mode if img.mode in ('L', 'RGB') else 'RGB').save(
+            data, 'JPEG', quality=config['IMAGE_JPEG_QUALITY'])
+    else:
+        if img.mode not in ('1', 'L', 'LA', 'RGB', 'RGBA'):
+            has_alpha = 'A' in img.getbands() or 'transparency' in img.info
+            img = img.convert('RGBA' if has_alpha else 'RGB')
+        img.save(data, 'PNG', compress_level=1)
+    return data.getvalue()
+
+
+def _prepare_image_pages(path, target_dpi):
+    """Decode and downscale one image file into page specs, using only Pillow.
+
+    Runs in worker threads: Pillow releases the GIL while decoding,
+    resampling and encoding. A JPEG that needs no downscaling is never
+    decoded and is embedded as-is; one that does is decoded with ``draft()``
+    at the smallest DCT scale that still covers the target size, so a large
+    photo never exists as a full-resolution bitmap. Returns one
+    ``{'width', 'height', 'rotate', 'stream' or 'filename'}`` dict per page.
+    """
+    from PIL import Image, ImageSequence
+    pages = []
+    with Image.open(path) as img:
+        if img.format == 'JPEG':
+            # Page size comes from the full-size header, before draft() shrinks it
+            frames = [(img, _image_page_size(img, target_dpi))]
+            width, height, pixel_size = frames[0][1]
+            rotate = _EXIF_ROTATIONS.get(img.getexif().get(0x0112, 1))
+            if rotate is not None and not pixel_size and img.mode in ('L', 'RGB'):
+                if rotate in (90, -90):
+                    width, height = height, width
+                return [{'width': width, 'height': height, 'rotate': rotate, 'filename': path}]
+            if pixel_size:
+                img.draft(img.mode, pixel_size)
+        else:
+            # Multi-page TIFFs yield one frame per page
+            frames = ((frame, _image_page_size(frame, target_dpi)) for frame in ImageSequence.Iterator(img))
+        
+        for frame, (width, height, pixel_size) in frames:
+            lossy = img.format == 'JPEG' or frame.info.get('compression') in ('jpeg', 'tiff_jpeg')
+            orientation = frame.getexif().get(0x0112, 1)
+            image = frame.resize(pixel_size, Image.LANCZOS, reducing_gap=3.0) if pixel_size else frame
+            if orientation in _EXIF_TRANSPOSES:
+                image = image.transpose(_EXIF_TRANSPOSES[orientation])
+                if orientation in (5, 6, 7, 8):
+                    width, height = height, width
+            pages.append({'width': width, 'height': height, 'rotate': 0, 'stream': _encode_frame(image, lossy)})
+    return pages
+
+
+def _prepared_images(image_paths, target_dpi):
+    """Yield ``(path, pages)`` in order while later images are prepared in worker threads.
+
+    At most twice IMAGE_WORKERS images are in flight, so memory stays
+    bounded however many images there are.
+    """
+    workers = max(1, config['IMAGE_WORKERS'])
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        pending = deque()
+        remaining = iter(image_paths)
+        for path in remaining:
+            pending.append((path, pool.submit(_prepare_image_pages, path, target_dpi)))
+            if len(pending) >= workers * 2:
+                break
+        while pending:
+            path, future = pending.popleft()
+            for next_path in remaining:
+                pending.append((next_path, pool.submit(_prepare_image_pages, next_path, target_dpi)))
+                break
+            yield path, future.result()
+
+
+def convert_images(image_paths, output_prefix, target_dpi=None):
+    """Convert each image file to its own PDF and return ``{image_path: pdf_path}``.
+
+    PDFs are written as ``<output_prefix>.<random>.pdf``; the caller deletes
+    them (see ``remove_converted``). ``target_dpi`` defaults to
+    IMAGE_TARGET_DPI.
+    """
+    import fitz  # PyMuPDF
+    if target_dpi is None:
+        target_dpi = config['IMAGE_TARGET_DPI']
+    converted = {}
+    try:
+        for image_path, pages in _prepared_images(list(dict.fromkeys(image_paths)), target_dpi):
+            pdf_path = f'{output_prefix}.{uuid.uuid4().hex}.pdf'
+            converted[image_path] = pdf_path
+            # Pages are assembled here, one image at a time: fitz is not used from several threads
+            with timed('convert'), fitz.open() as doc:
+                for spec in pages:
+                    page = doc.new_page(width=spec['width'], height=spec['height'])
+                    page.insert_image(page.rect, stream=spec.get('stream'), filename=spec.get('filename'),
+                                      rotate=spec['rotate'])
+                # MuPDF stores decoded PNG data uncompressed; JPEG streams are kept as they are
+                doc.save(pdf_path, deflate=True)
+            count_output('convert', len(pages), pdf_path)
+    except Exception:
+        remove_converted(converted)
+        raise
+    return converted
+
+
+def remove_converted(converted):
+    """Delete PDFs made by ``convert_images``, closing any pooled handles first"""
+    for pdf_path in converted.values():
+        document_pool.discard(pdf_path)
+        try:
+            os.remove(pdf_path)
+        except OSError:
+            pass
+
+
+# OUTPUT OPTIMIZATION
+
+# PyMuPDF save options per optimization level:
+# 1 drops unused objects and compresses uncompressed streams,
+# 2 also merges duplicate objects and recompresses images and fonts,
+# 3 also compares stream contents to merge identical streams and packs
+#   objects into compressed object streams
+OPTIMIZE_LEVELS = {
+    1: {'garbage': 1, 'deflate': True},
+    2: {'garbage': 3, 'deflate': True, 'deflate_images': True, 'deflate_fonts': True},
+    3: {'garbage': 4, 'deflate': True, 'deflate_images': True, 'deflate_fonts': True, 'use_objstms': 1},
+}
+
+
+def optimize_pdf(path, level):
+    """Rewrite a PDF in place with deduplicated objects and recompressed streams.
+
+    The original is kept if the rewrite isn't smaller. Returns a dict with
+    ``bytes_before``, ``bytes_after`` and ``bytes_saved``, or None for level 0.
+    """
+    if not level:
+        return None
+    import fitz  # PyMuPDF
+    options = OPTIMIZE_LEVELS[min(level, max(OPTIMIZE_LEVELS))]
+    bytes_before = os.path.getsize(path)
+    tmp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+    try:
+        with timed('optimize'), fitz.open(path, filetype='pdf') as doc:
+            doc.save(tmp_path, **options)
+        bytes_after = os.path.getsize(tmp_path)
+        if bytes_after < bytes_before:
+            os.replace(tmp_path, path)
+        else:
+            bytes_after = bytes_before
+    finally:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+    return {
+        'bytes_before': bytes_before,
+        'bytes_after': bytes_after,
+        'bytes_saved': bytes_before - bytes_after
+    }
+
+
+# PAGE EDITS
+
+def compile_edit_operations(total_pages, removed_pages, page_order, insertions, inserted_docs=None):
+    """Normalize an edit payload into an ordered list of operations.
+
+    Returns ``('pages', [0-based page indices])`` runs and
+    ``('insert', (pool_key, path, ranges))`` entries, where ``ranges`` is a
+    list of 0-based inclusive ``(first, last)`` pages or None for the whole
+    document; consecutive kept pages are coalesced into one run.
+    ``insertions`` maps ``insert_after_<key>`` names to lists of PDF paths.
+    ``inserted_docs`` maps uploaded file IDs to ``{'path', 'key',
+    'page_count'}``; a ``{'type': 'file', 'value': <file ID>, 'pages':
+    '2-4'}`` item in ``page_order`` inserts those pages of that file (all
+    of them when ``pages`` is empty).
+    """
+    operations = []
+    inserted_docs = inserted_docs or {}
+    
+    def keep_page(page_num):
+        if page_num in removed_pages:
+            return
+        if not 1 <= page_num <= total_pages:
+            raise ValueError(f'Invalid page number: {page_num}')
+        if operations and operations[-1][0] == 'pages':
+            operations[-1][1].append(page_num - 1)
+        else:
+            operations.append(('pages', [page_num - 1]))
+    
+    def insert_files(insert_key):
+        for insert_path in insertions.get(insert_key, []):
+            operations.append(('insert', (insert_path, insert_path, None)))
+    
+    def insert_uploaded(file_id, pages):
+        inserted = inserted_docs.get(file_id)
+        if inserted is None:
+            raise ValueError(f'Unknown inserted file: {file_id}')
+        ranges = None
+        if pages and pages.strip():
+            ranges = [(first - 1, last - 1) for first, last in parse_page_ranges(pages, inserted['page_count'])]
+        operations.append(('insert', (inserted['key'], inserted['path'], ranges)))
+    
+    # If page order is provided, use it; otherwise use default sequential order
+    if page_order and len(page_order) > 0:
+        for item in page_order:
+            if item['type'] == 'page':
+                keep_page(int(item['value']))
+            elif item['type'] == 'insert':
+                insert_files(f"insert_after_{item['value']}")
+            elif item['type'] == 'file':
+                insert_uploaded(item['value'], item.get('pages'))
+    else:
+        for page_num in range(1, total_pages + 1):
+            keep_page(page_num)
+            # Check for insertions after this page (including nested ones)
+            for insert_key in insertions:
+                if insert_key.startswith(f'insert_after_{page_num}'):
+                    insert_files(insert_key)
+    
+    return operations
+
+
+def _run_edit_operations_fitz(pdf_path, output_path, operations, total_pages, progress):
+    import fitz  # PyMuPDF
+    selected = [index for kind, value in operations if kind == 'pages' for index in value]
+    has_inserts = any(kind == 'insert' for kind, _ in operations)
+    doc = None
+    try:
+        if not has_inserts and sorted(selected) == list(range(total_pages)):
+            # Reorder only: every object stays in use, so append just the new page tree
+            import shutil
+            shutil.copyfile(pdf_path, output_path)
+            with timed('parse'):
+                doc = fitz.open(output_path, filetype='pdf')
+            if doc.can_save_incrementally():
+                with timed('edit'):
+                    doc.select(selected)
+                with timed('write'):
+                    doc.save(output_path, incremental=True, encryption=fitz.PDF_ENCRYPT_KEEP)
+                if progress:
+                    progress(len(doc))
+                return len(doc)
+            # Repaired files can't take an incremental update; rewrite them below
+            doc.close()
+        
+        with timed('parse'):
+            doc = fitz.open(pdf_path, filetype='pdf')
+        
+        # One select() call applies all removals and reordering
+        with timed('edit'):
+            if selected:
+                doc.select(selected)
+            else:
+                doc.close()
+                doc = fitz.open()
+        
+        position = 0
+        for kind, value in operations:
+            if kind == 'pages':
+                position += len(value)
+            else:
+                key, insert_path, ranges = value
+                with timed('edit'), document_pool.borrow(key, insert_path) as insert_doc:
+                    for first, last in ranges or [(0, len(insert_doc) - 1)]:
+                        doc.insert_pdf(insert_doc, from_page=first, to_page=last, start_at=position)
+                        position += last - first + 1
+            if progress:
+                progress(position)
+        
+        # garbage=1 drops objects only the removed pages used
+        with timed('write'):
+            doc.save(output_path, garbage=1)
+        return len(doc)
+    finally:
+        if doc is not None:
+            doc.close()
+
+
+def _run_edit_operations_pypdf2(pdf_path, output_path, operations, progress):
+    from PyPDF2 import PdfReader, PdfWriter
+    reader = PdfReader(pdf_path)
+    writer = PdfWriter()
+    insert_readers = {}
+    
+    for kind, value in operations:
+        if kind == 'pages':
+            for index in value:
+                writer.add_page(reader.pages[index])
+        else:
+            # Add the selected pages of the inserted PDF, parsing each blob once
+            key, insert_path, ranges = value
+            if key not in insert_readers:
+                insert_readers[key] = PdfReader(insert_path)
+            insert_pages = insert_readers[key].pages
+            for first, last in ranges or [(0, len(insert_pages) - 1)]:
+                for index in range(first, last + 1):
+                    writer.add_page(insert_pages[index])
+        if progress:
+            progress(len(writer.pages))
+    
+    with timed('write'), open(output_path, 'wb') as output_file:
+        writer.write(output_file)
+    return len(writer.pages)
+
+
+def apply_page_edits(pdf_path, output_path, removed_pages, page_order, insertions, progress=None, total_pages=None,
+                     image_dpi=None, inserted_docs=None):
+    """Write ``pdf_path`` to ``output_path`` with pages removed, inserted and reordered.
+
+    The edit is compiled into operations and run with PyMuPDF, falling back to
+    PyPDF2 for documents PyMuPDF cannot process. Inserted images are
+    converted to PDF pages first, as in ``merge_files``; ``inserted_docs``
+    (see ``compile_edit_operations``) must already be PDFs. ``total_pages``
+    normally comes from the session manifest; the PDF is only opened to count
+    pages when it is missing. ``progress``, if given, is called as
+    ``progress(pages_written)``. Returns the output page count.
+    """
+    if total_pages is None:
+        import fitz  # PyMuPDF
+        with timed('parse'), fitz.open(pdf_path, filetype='pdf') as doc:
+            total_pages = len(doc)
+    images = [path for paths in insertions.values() for path in paths if image_format(path)]
+    converted = convert_images(images, output_path, image_dpi) if images else {}
+    try:
+        insertions = {key: [converted.get(path, path) for path in paths] for key, paths in insertions.items()}
+        operations = compile_edit_operations(total_pages, removed_pages, page_order, insertions, inserted_docs)
+        try:
+            pages = _run_edit_operations_fitz(pdf_path, output_path, operations, total_pages, progress)
+        except Exception as e:
+            print(f"PyMuPDF edit failed, falling back to PyPDF2: {e}")
+            pages = _run_edit_operations_pypdf2(pdf_path, output_path, operations, progress)
+    finally:
+        remove_converted(converted)
+    count_output('edit', pages, output_path)
+    return pages
+
+
+# SPLITTING
+
+SPLIT_MODES = ('ranges', 'every', 'bookmarks')
+
+
+def parse_page_ranges(spec, total_pages):
+    """Parse ``"1-3, 5, 8-"`` into 1-based inclusive ``(first, last)`` ranges, one per item"""
+    ranges = []
+    for item in re.split(r'[,;\s]+', spec.strip()):
+        if not item:
+            continue
+        first, sep, last = item.partition('-')
+        try:
+            first = int(first) if first else 1
+            last = (int(last) if last else total_pages) if sep else first
+        except ValueError:
+            raise ValueError(f'Invalid page range: {item}')
+        if not 1 <= first <= last <= total_pages:
+            raise ValueError(f'Page range out of bounds: {item} (document has {total_pages} pages)')
+        ranges.append((first, last))
+    if not ranges:
+        raise ValueError('No page ranges given')
+    return ranges
+
+
+def _bookmark_ranges(toc, total_pages, level):
+    """Start a range at every bookmark at ``level`` or above; pages before the first one form their own range"""
+    starts = {}
+    for entry_level, title, page in toc:
+        if entry_level <= level and 1 <= page <= total_pages:
+            starts.setdefault(page, title)
+    if not starts:
+        raise ValueError('The document has no bookmarks to split at')
+    if 1 not in starts:
+        starts[1] = 'front matter'
+    pages = sorted(starts)
+    return [(starts[first], first, last - 1) for first, last in zip(pages, pages[1:] + [total_pages + 1])]
+
+
+def _part_filename(title):
+    return re.sub(r'[^\w.-]+', '_', title).strip('._')[:60] or 'section'
+
+
+def _range_part_name(first, last):
+    return f'pages_{first}-{last}' if last > first else f'page_{first}'
+
+
+def plan_split(mode, value, total_pages, toc=()):
+    """Return the parts of a split as ``(filename, first_page, last_page)``, 1-based inclusive.
+
+    ``mode`` is ``ranges`` (``value`` like ``"1-3, 5, 8-"``), ``every``
+    (``value`` pages per part) or ``bookmarks`` (``value`` is the deepest
+    bookmark level to split at, default 1; ``toc`` comes from
+    ``doc.get_toc()``). Raises ValueError for an invalid request.
+    """
+    if mode == 'ranges':
+        named = [(_range_part_name(first, last), first, last) for first, last in parse_page_ranges(value, total_pages)]
+    elif mode == 'every':
+        try:
+            size = int(value)
+        except (TypeError, ValueError):
+            raise ValueError('Pages per part must be a number')
+        if size < 1:
+            raise ValueError('Pages per part must be at least 1')
+        named = [(_range_part_name(first, min(first + size - 1, total_pages)), first, min(first + size - 1, total_pages))
+                 for first in range(1, total_pages + 1, size)]
+    elif mode == 'bookmarks':
+        try:
+            level = int(value or 1)
+        except ValueError:
+            raise ValueError('Bookmark level must be a number')
+        named = [(_part_filename(title), first, last) for title, first, last in _bookmark_ranges(toc, total_pages, level)]
+    else:
+        raise ValueError(f'Unknown split mode: {mode}')
+    
+    if len(named) > config['SPLIT_MAX_PARTS']:
+        raise ValueError(f"A split can produce at most {config['SPLIT_MAX_PARTS']} parts")
+    # Number the parts so archive order matches document order
+    width = len(str(len(named)))
+    return [(f'{idx:0{width}d}_{name}.pdf', first, last) for idx, (name, first, last) in enumerate(named, start=1)]
+
+
+def extract_part(src, output_path, first, last):
+    """Write pages ``first``..``last`` (1-based, inclusive) of open document ``src`` to ``output_path``"""
+    import fitz  # PyMuPDF
+    with timed('split'), fitz.open() as part:
+        part.insert_pdf(src, from_page=first - 1, to_page=last - 1)
+        part.save(output_path, garbage=1)
+    count_output('split', last - first + 1, output_path)
+
+
+def _extract_parts_task(pdf_path, batch):
+    # The source is opened here rather than borrowed from document_pool: a
+    # handle pooled in a worker process would outlive the session it belongs to
+    import fitz  # PyMuPDF
+    with fitz.open(pdf_path) as src:
+        for output_path, first, last in batch:
+            extract_part(src, output_path, first, last)
+    return metrics.drain()
+
+
+def split_pdf(pdf_path, parts, output_dir, executor=None):
+    """Extract ``plan_split`` parts into ``output_dir`` and yield ``(filename, path)`` in part order.
+
+    With a process ``executor`` every part is submitted up front in batches
+    of ``SPLIT_BATCH_PARTS``, so later parts are extracted while the caller
+    consumes earlier ones; batches not yet started are cancelled if the
+    caller stops early. Without one, parts are extracted one at a time as
+    they are consumed. The caller owns the files.
+    """
+    import fitz  # PyMuPDF
+    paths = [os.path.join(output_dir, f'part_{idx}.pdf') for idx in range(len(parts))]
+    if executor is None:
+        with fitz.open(pdf_path) as src:
+            for (filename, first, last), path in zip(parts, paths):
+                extract_part(src, path, first, last)
+                yield filename, path
+        return
+    
+    size = max(1, config['SPLIT_BATCH_PARTS'])
+    futures = []
+    for start in range(0, len(parts), size):
+        batch = [(path, first, last) for (_, first, last), path in zip(parts[start:start + size], paths[start:start + size])]
+        futures.append(executor.submit(_extract_parts_task, pdf_path, batch))
+    try:
+        for idx, ((filename, _, _), path) in enumerate(zip(parts, paths)):
+            if idx % size == 0:
+                metrics.merge(futures[idx // size].result())
+            yield filename, path
+    finally:
+        for future in futures:
+            future.cancel()
+
+
+# WARM-UP
+
+def load_pdf_libraries():
+    """Import PyMuPDF, PyPDF2 and Pillow and run PyMuPDF once so its lazy setup is done"""
+    import fitz  # PyMuPDF
+    from PyPDF2 import PdfMerger, PdfReader, PdfWriter  # noqa: F401
+    from PIL import Image  # noqa: F401
+    # Rendering one tiny page initialises MuPDF's fonts, colorspaces and JPEG encoder
+    with fitz.open() as doc:
+        page = doc.new_page(width=72, height=72)
+        page.insert_text((10, 40), 'warm')
+        page.get_pixmap(alpha=False).tobytes('jpeg')
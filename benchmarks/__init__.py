@@ -0,0 +1,4 @@
+"""Reproducible benchmarks for the merge, upload, thumbnail and edit paths.
+
+Run ``python -m benchmarks.run --help`` from the repository root.
+"""
@@ -0,0 +1,311 @@
+"""Benchmark cases.
+
+Each case takes the imported ``app`` module and the corpus and returns a
+``(setup, run)`` pair. ``setup`` (which may be None) prepares untimed state
+for one repetition and ``run(state)`` does the timed work, returning the
+number of bytes it wrote or served.
+"""
+import io
+import json
+import os
+import sys
+import uuid
+
+import fitz  # PyMuPDF
+
+API_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'api')
+
+
+def load_app():
+    """Import api/app.py configured for benchmarking"""
+    if API_DIR not in sys.path:
+        sys.path.insert(0, API_DIR)
+    import app as app_module
+    # Background pre-rendering would race the thumbnail cases
+    app_module.app.config['THUMBNAIL_PRERENDER_PAGES'] = 0
+    return app_module
+
+
+def _check(response):
+    if response.status_code >= 400:
+        raise RuntimeError(f'{response.request.path} returned {response.status_code}: {response.get_data(as_text=True)[:200]}')
+    return response
+
+
+def _merged_size(app_module, filename):
+    path = os.path.join(app_module.app.config['MERGED_FOLDER'], filename)
+    size = os.path.getsize(path)
+    os.remove(path)
+    return size
+
+
+def _new_session(app_module, pdf_path):
+    client = app_module.app.test_client()
+    with open(pdf_path, 'rb') as f:
+        response = _check(client.post('/process-upload-for-edit', data={'pdf_file': (f, 'bench.pdf')},
+                                      content_type='multipart/form-data'))
+    return client, response.get_json()['session_id'], response.get_json()['total_pages']
+
+
+def _output_path(app_module, name):
+    return os.path.join(app_module.app.config['MERGED_FOLDER'], f'bench_{name}.pdf')
+
+
+# Core functions
+
+def core_merge_engine(engine_name, corpus_set):
+    def case(app_module, corpus):
+        paths = [path for name in corpus_set for path in corpus[name]]
+        output_path = _output_path(app_module, engine_name or 'default')
+
+        def run(state):
+            app_module.merge_files(paths, output_path, engine_name)
+            return os.path.getsize(output_path)
+        return None, run
+    return case
+
+
+def core_merge_repeated(app_module, corpus):
+    # The same cover sheet between every document, as in batch mailings
+    cover = corpus['images'][0]
+    paths = [path for doc in corpus['text'] for path in (cover, doc)]
+    output_path = _output_path(app_module, 'repeated')
+
+    def run(state):
+        app_module.merge_files(paths, output_path)
+        return os.path.getsize(output_path)
+    return None, run
+
+
+def core_merge_photos(image_dpi):
+    # Peak RSS should stay far below one decoded photo per worker thread
+    def case(app_module, corpus):
+        paths = corpus['photos']
+        output_path = _output_path(app_module, f'photos_{image_dpi}')
+
+        def run(state):
+            app_module.merge_files(paths, output_path, image_dpi=image_dpi)
+            return os.path.getsize(output_path)
+        return None, run
+    return case
+
+
+def batch_merge(app_module, corpus):
+    # Throughput should grow with the worker count; compare runs on different core counts
+    import pdf_batch
+    paths = corpus['text'] + corpus['fonts']
+    bundles = [(_output_path(app_module, f'batch_{n}'), [paths[(n + k) % len(paths)] for k in range(3)])
+               for n in range(32)]
+
+    def run(state):
+        results = list(pdf_batch.run_batch(bundles, workers=os.cpu_count()))
+        failed = [result for result in results if result['status'] != 'ok']
+        if failed:
+            raise RuntimeError(f'{len(failed)} bundles failed: {failed[0]}')
+        return sum(result['bytes'] for result in results)
+    return None, run
+
+
+def core_edit(kind):
+    def case(app_module, corpus):
+        pdf_path = corpus['long'][0]
+        insert_path = corpus['text'][0]
+        output_path = _output_path(app_module, f'edit_{kind}')
+        with fitz.open(pdf_path) as doc:
+            total_pages = len(doc)
+        pages = list(range(total_pages, 0, -1))
+        page_order = [{'type': 'page', 'value': str(n)} for n in pages]
+        removed, insertions = set(), {}
+        if kind == 'mixed':
+            removed = set(range(2, total_pages, 3))
+            page_order.insert(1, {'type': 'insert', 'value': '1'})
+            insertions = {'insert_after_1': [insert_path]}
+
+        def run(state):
+            app_module.apply_page_edits(pdf_path, output_path, removed, page_order, insertions, total_pages=total_pages)
+            return os.path.getsize(output_path)
+        return None, run
+    return case
+
+
+def core_render_thumbnails(app_module, corpus):
+    pdf_path = corpus['long'][0]
+
+    def run(state):
+        written = 0
+        with fitz.open(pdf_path) as doc:
+            for page_num in range(1, len(doc) + 1):
+                written += len(app_module.render_page_thumbnail(doc, page_num))
+        return written
+    return None, run
+
+
+# Flask routes through the test client
+
+def route_merge(app_module, corpus):
+    client = app_module.app.test_client()
+    paths = corpus['text']
+
+    def run(state):
+        files = [(open(path, 'rb'), os.path.basename(path)) for path in paths]
+        try:
+            response = _check(client.post('/merge', data={'pdf_files': files}, content_type='multipart/form-data'))
+        finally:
+            for f, _ in files:
+                f.close()
+        return _merged_size(app_module, response.get_json()['filename'])
+    return None, run
+
+
+def _upload_in_chunks(client, path, chunk_size=256 * 1024):
+    file_id = f"bench_{uuid.uuid4().hex}"
+    with open(path, 'rb') as f:
+        data = f.read()
+    total_chunks = max(1, -(-len(data) // chunk_size))
+    for chunk_number in range(total_chunks):
+        chunk = data[chunk_number * chunk_size:(chunk_number + 1) * chunk_size]
+        _check(client.post('/upload-chunk', data={
+            'chunk': (io.BytesIO(chunk), 'blob'),
+            'chunkNumber': chunk_number,
+            'totalChunks': total_chunks,
+            'chunkSize': chunk_size,
+            'totalSize': len(data),
+            'fileId': file_id,
+            'filename': os.path.basename(path)
+        }, content_type='multipart/form-data'))
+    return file_id
+
+
+def route_chunked_merge(app_module, corpus):
+    client = app_module.app.test_client()
+    paths = corpus['text'] + corpus['images']
+
+    def run(state):
+        file_ids = [_upload_in_chunks(client, path) for path in paths]
+        response = _check(client.post('/merge-chunked', data={'fileIds[]': file_ids}))
+        return _merged_size(app_module, response.get_json()['filename'])
+    return None, run
+
+
+def route_page_image(app_module, corpus):
+    def setup():
+        return _new_session(app_module, corpus['long'][0])
+
+    def run(state):
+        client, session_id, total_pages = state
+        served = 0
+        for page_num in range(1, total_pages + 1):
+            served += len(_check(client.get(f'/page-image/{session_id}/{page_num}')).data)
+        return served
+    return setup, run
+
+
+def route_page_image_revalidate(app_module, corpus):
+    # A repeat view: every preview is revalidated with the ETag from the first
+    def setup():
+        client, session_id, total_pages = _new_session(app_module, corpus['long'][0])
+        etags = [_check(client.get(f'/page-image/{session_id}/{n}')).headers['ETag'] for n in range(1, total_pages + 1)]
+        return client, session_id, etags
+
+    def run(state):
+        client, session_id, etags = state
+        served = 0
+        for page_num, etag in enumerate(etags, start=1):
+            response = client.get(f'/page-image/{session_id}/{page_num}', headers={'If-None-Match': etag})
+            if response.status_code != 304:
+                raise RuntimeError(f'page {page_num} was not revalidated: {response.status_code}')
+            served += len(response.data)
+        return served
+    return setup, run
+
+
+def route_page_images_batch(app_module, corpus):
+    window = 12
+
+    def setup():
+        return _new_session(app_module, corpus['long'][0])
+
+    def run(state):
+        client, session_id, total_pages = state
+        served = 0
+        for start in range(1, total_pages + 1, window):
+            served += len(_check(client.get(f'/page-images/{session_id}?start={start}&end={start + window - 1}')).data)
+        return served
+    return setup, run
+
+
+def route_split(app_module, corpus):
+    # One part per page, extracted by the split worker pool and streamed as a ZIP
+    def setup():
+        return _new_session(app_module, corpus['long'][0])
+
+    def run(state):
+        client, session_id, total_pages = state
+        response = _check(client.post('/split', data={'session_id': session_id, 'mode': 'every', 'value': '1'}))
+        return len(response.data)
+    return setup, run
+
+
+def route_apply_edits(app_module, corpus):
+    def setup():
+        return _new_session(app_module, corpus['long'][0])
+
+    def run(state):
+        client, session_id, total_pages = state
+        page_order = [{'type': 'page', 'value': str(n)} for n in range(total_pages, 0, -1)]
+        _check(client.post('/apply-edits', data={
+            'session_id': session_id,
+            'removed_pages': json.dumps([1, 2, 3]),
+            'page_order': json.dumps(page_order)
+        }))
+        output_path = os.path.join(app_module.app.config['EDIT_FOLDER'], session_id, 'edited.pdf')
+        return os.path.getsize(output_path)
+    return setup, run
+
+
+def route_apply_edits_inserts(app_module, corpus):
+    # Inserts are uploaded and attached once; each apply only sends their file IDs
+    def setup():
+        client, session_id, total_pages = _new_session(app_module, corpus['long'][0])
+        file_ids = [_upload_in_chunks(client, path) for path in corpus['text']]
+        for file_id in file_ids:
+            _check(client.post('/edit-inserts', data={'session_id': session_id, 'fileId': file_id}))
+        return client, session_id, total_pages, file_ids
+
+    def run(state):
+        client, session_id, total_pages, file_ids = state
+        page_order = []
+        for page_num in range(1, total_pages + 1):
+            page_order.append({'type': 'page', 'value': str(page_num)})
+            if page_num % 10 == 0:
+                page_order.append({'type': 'file', 'value': file_ids[page_num // 10 % len(file_ids)], 'pages': '1'})
+        for _ in range(3):
+            _check(client.post('/apply-edits', data={'session_id': session_id, 'page_order': json.dumps(page_order)}))
+        output_path = os.path.join(app_module.app.config['EDIT_FOLDER'], session_id, 'edited.pdf')
+        return os.path.getsize(output_path)
+    return setup, run
+
+
+CASES = {
+    'core_merge_fitz': core_merge_engine('fitz', ('text', 'fonts', 'images')),
+    'core_merge_pypdf2': core_merge_engine('pypdf2', ('text', 'fonts', 'images')),
+    'core_merge_malformed': core_merge_engine(None, ('malformed',)),
+    # Peak RSS of this case should stay flat as the 'many' set grows; benchmarks.memory asserts it
+    'core_merge_streaming_many': core_merge_engine('fitz-streaming', ('many',)),
+    'core_merge_repeated': core_merge_repeated,
+    # JPEGs embedded as-is, then decoded with draft() and downscaled
+    'core_merge_photos_original': core_merge_photos(0),
+    'core_merge_photos_150dpi': core_merge_photos(150),
+    'batch_merge': batch_merge,
+    'core_edit_reorder': core_edit('reorder'),
+    'core_edit_mixed': core_edit('mixed'),
+    'core_render_thumbnails': core_render_thumbnails,
+    'route_merge': route_merge,
+    'route_chunked_merge': route_chunked_merge,
+    'route_page_image': route_page_image,
+    'route_page_image_revalidate': route_page_image_revalidate,
+    'route_page_images_batch': route_page_images_batch,
+    'route_split': route_split,
+    'route_apply_edits': route_apply_edits,
+    'route_apply_edits_inserts': route_apply_edits_inserts,
+}
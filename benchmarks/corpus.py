@@ -0,0 +1,132 @@
+"""Deterministic synthetic PDF corpus used by the benchmarks.
+
+Every document is generated from a fixed seed, so two runs with the same
+scale produce byte-for-byte comparable inputs. The corpus covers plain text
+documents of varied page counts, documents with embedded fonts, image-heavy
+documents, files whose xref table points at the wrong offsets and camera-sized
+JPEG photos for the image inputs.
+"""
+import os
+import random
+import re
+
+import fitz  # PyMuPDF
+
+SEED = 20240601
+
+# name -> (kind, pages, copies) per scale; for photos "pages" is the size in megapixels
+SCALES = {
+    'small': {
+        'text': ('text', 20, 4),
+        'long': ('text', 200, 1),
+        'fonts': ('fonts', 10, 2),
+        'images': ('images', 10, 2),
+        'malformed': ('malformed', 10, 2),
+        'many': ('text', 1, 100),
+        'photos': ('photo', 6, 4),
+    },
+    'full': {
+        'text': ('text', 50, 8),
+        'long': ('text', 1000, 1),
+        'fonts': ('fonts', 40, 4),
+        'images': ('images', 60, 3),
+        'malformed': ('malformed', 30, 4),
+        'many': ('text', 2, 1000),
+        'photos': ('photo', 24, 8),
+    },
+}
+
+
+def _text_page(doc, rng, page_num, fontname='helv'):
+    page = doc.new_page(width=595, height=842)
+    page.insert_text((72, 72), f"Benchmark page {page_num}", fontsize=20, fontname=fontname)
+    lines = [' '.join(rng.choice(('alpha', 'beta', 'gamma', 'delta', 'merge', 'page', 'pdf'))
+                      for _ in range(12)) for _ in range(40)]
+    page.insert_textbox(fitz.Rect(72, 100, 523, 780), '\n'.join(lines), fontsize=9, fontname=fontname)
+    return page
+
+
+def _build_text(rng, pages):
+    doc = fitz.open()
+    for page_num in range(1, pages + 1):
+        _text_page(doc, rng, page_num)
+    doc.set_toc([[1, f'Section {n}', n] for n in range(1, pages + 1, max(1, pages // 5))])
+    return doc
+
+
+def _build_fonts(rng, pages):
+    doc = fitz.open()
+    # Embedded font programs rather than base-14 references
+    fonts = [('F0', fitz.Font('tiro')), ('F1', fitz.Font('cour')), ('F2', fitz.Font('helv'))]
+    for page_num in range(1, pages + 1):
+        page = doc.new_page(width=595, height=842)
+        for idx, (name, font) in enumerate(fonts):
+            page.insert_font(fontname=name, fontbuffer=font.buffer)
+            page.insert_text((72, 100 + idx * 40), f"Font {name} on page {page_num} {rng.random():.6f}",
+                             fontname=name, fontsize=14)
+    return doc
+
+
+def _build_images(rng, pages):
+    doc = fitz.open()
+    for page_num in range(1, pages + 1):
+        page = _text_page(doc, rng, page_num)
+        width, height = 400, 300
+        # Deterministic noise so JPEG decoding and rendering have real work to do
+        noisy = fitz.Pixmap(fitz.csRGB, width, height, rng.randbytes(width * height * 3), False)
+        page.insert_image(fitz.Rect(72, 420, 523, 760), stream=noisy.tobytes('jpeg', jpg_quality=85))
+    return doc
+
+
+def _build_photo(rng, megapixels):
+    """A 3:2 JPEG of smooth deterministic noise, like a camera photo, at 300 dpi"""
+    width = int((megapixels * 1e6 * 1.5) ** 0.5)
+    height = width * 2 // 3
+    small = fitz.Pixmap(fitz.csRGB, 120, 80, rng.randbytes(120 * 80 * 3), False)
+    photo = fitz.Pixmap(small, width, height, None)
+    photo.set_dpi(300, 300)
+    return photo.tobytes('jpeg', jpg_quality=85)
+
+
+def _corrupt_xref(data):
+    """Point startxref and every xref entry at the wrong offsets"""
+    data = re.sub(rb'startxref\s+(\d+)', lambda m: b'startxref\n' + str(int(m.group(1)) + 17).encode(), data)
+    return re.sub(rb'(\d{10}) (\d{5}) n', lambda m: b'%010d %s n' % (int(m.group(1)) + 3, m.group(2)), data)
+
+
+BUILDERS = {
+    'text': _build_text,
+    'fonts': _build_fonts,
+    'images': _build_images,
+    'malformed': _build_text,
+    'photo': _build_photo,
+}
+
+
+def generate_corpus(directory, scale='small'):
+    """Write the corpus for ``scale`` into ``directory`` if missing.
+
+    Returns a dict mapping each set name to its list of file paths.
+    """
+    os.makedirs(directory, exist_ok=True)
+    corpus = {}
+    for name, (kind, pages, copies) in SCALES[scale].items():
+        corpus[name] = []
+        for copy in range(copies):
+            extension = 'jpg' if kind == 'photo' else 'pdf'
+            path = os.path.join(directory, f'{scale}_{name}_{copy}.{extension}')
+            if not os.path.exists(path):
+                rng = random.Random(f'{SEED}-{scale}-{name}-{copy}')
+                built = BUILDERS[kind](rng, pages)
+                if kind == 'photo':
+                    data = built
+                else:
+                    # no_new_id keeps the output byte-for-byte reproducible
+                    data = built.tobytes(garbage=1, no_new_id=True)
+                    built.close()
+                if kind == 'malformed':
+                    data = _corrupt_xref(data)
+                with open(path, 'wb') as f:
+                    f.write(data)
+            corpus[name].append(path)
+    return corpus
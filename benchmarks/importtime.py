@@ -0,0 +1,81 @@
+"""Cold-start report: what importing the app and its first request cost.
+
+Each measurement runs in a fresh interpreter with ``-X importtime``. The
+child imports the app, serves one template-only request, notes which PDF
+libraries that loaded (there should be none), then calls ``warm_up()``, so
+the import log covers the heavy libraries as well.
+"""
+import json
+import statistics
+import subprocess
+import sys
+
+from benchmarks.cases import API_DIR
+
+# Modules whose cumulative import time is reported
+TRACKED_MODULES = ('flask', 'fitz', 'PyPDF2', 'PIL.Image')
+
+_CHILD = f"""
+import json, sys, time
+sys.path.insert(0, {API_DIR!r})
+start = time.perf_counter()
+import app
+imported = time.perf_counter()
+app.app.test_client().get('/')
+served = time.perf_counter()
+loaded = [name for name in {TRACKED_MODULES[1:]!r} if name in sys.modules]
+warm_up = app.warm_up()
+print(json.dumps({{
+    'app_import_s': imported - start,
+    'first_template_request_s': served - imported,
+    'pdf_modules_loaded_by_template_route': loaded,
+    'warm_up_s': warm_up,
+}}))
+"""
+
+
+def _parse_importtime(log):
+    """Return {module: cumulative seconds} for every module in an -X importtime log"""
+    cumulative = {}
+    for line in log.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, _, rest = line.partition(':')
+        self_us, cumulative_us, name = rest.split('|')
+        cumulative.setdefault(name.strip(), int(cumulative_us) / 1e6)
+    return cumulative
+
+
+def measure_import_times(repeat=3):
+    """Median cold-start figures over ``repeat`` fresh interpreters"""
+    runs = []
+    for _ in range(repeat):
+        child = subprocess.run([sys.executable, '-X', 'importtime', '-c', _CHILD],
+                               capture_output=True, text=True, check=True)
+        result = json.loads(child.stdout.strip().splitlines()[-1])
+        modules = _parse_importtime(child.stderr)
+        result['modules_s'] = {name: modules.get(name) for name in TRACKED_MODULES}
+        runs.append(result)
+
+    def median(values):
+        values = [v for v in values if v is not None]
+        return round(statistics.median(values), 6) if values else None
+
+    return {
+        'repeat': repeat,
+        'app_import_s': median(run['app_import_s'] for run in runs),
+        'first_template_request_s': median(run['first_template_request_s'] for run in runs),
+        'pdf_modules_loaded_by_template_route': runs[-1]['pdf_modules_loaded_by_template_route'],
+        'warm_up_s': {step: median(run['warm_up_s'][step] for run in runs) for step in runs[-1]['warm_up_s']},
+        'modules_s': {name: median(run['modules_s'][name] for run in runs) for name in TRACKED_MODULES},
+    }
+
+
+def print_import_times(report):
+    print(f"{'app import':<28} {report['app_import_s'] * 1000:10.1f} ms", file=sys.stderr)
+    print(f"{'first template request':<28} {report['first_template_request_s'] * 1000:10.1f} ms"
+          f"  loaded {', '.join(report['pdf_modules_loaded_by_template_route']) or 'no PDF libraries'}",
+          file=sys.stderr)
+    for name, seconds in report['modules_s'].items():
+        if seconds is not None:
+            print(f"{'import ' + name:<28} {seconds * 1000:10.1f} ms", file=sys.stderr)
@@ -0,0 +1,117 @@
+"""Peak-memory check for the streaming merge engine.
+
+    python -m benchmarks.memory --inputs 250 --budget-mb 200
+
+Merges ``--inputs`` and then four times as many generated PDFs with
+``fitz-streaming``, each in a fresh interpreter, and reads the child's peak
+RSS. The check fails (exit status 1) if either merge goes over
+``--budget-mb``, or if the larger merge's peak is more than ``--growth``
+above the smaller one's: with a bounded engine, memory depends on the batch
+size, not on how many files are merged.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+
+from benchmarks.cases import API_DIR
+from benchmarks.corpus import BUILDERS, SEED
+
+DEFAULT_INPUTS = 250
+DEFAULT_BUDGET_MB = 200
+DEFAULT_GROWTH = 0.15
+
+_CHILD = f"""
+import json, resource, sys
+sys.path.insert(0, {API_DIR!r})
+import pdf_core
+paths, output_path = json.loads(sys.stdin.read())
+pdf_core.load_pdf_libraries()
+before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+engine = pdf_core.merge_files(paths, output_path, 'fitz-streaming')
+peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+divisor = 1024 if sys.platform == 'darwin' else 1
+print(json.dumps({{'engine': engine, 'before_kb': before // divisor, 'peak_kb': peak // divisor}}))
+"""
+
+
+def generate_inputs(directory, count):
+    """Write ``count`` distinct one-page, image-heavy PDFs (about 100KB each) if missing"""
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for idx in range(count):
+        path = os.path.join(directory, f'memory_{idx}.pdf')
+        if not os.path.exists(path):
+            doc = BUILDERS['images'](random.Random(f'{SEED}-memory-{idx}'), 1)
+            data = doc.tobytes(garbage=1, no_new_id=True)
+            doc.close()
+            with open(path, 'wb') as f:
+                f.write(data)
+        paths.append(path)
+    return paths
+
+
+def measure_merge(paths, output_path):
+    """Merge ``paths`` in a fresh interpreter and return its engine and RSS figures"""
+    try:
+        child = subprocess.run([sys.executable, '-c', _CHILD], input=json.dumps([paths, output_path]),
+                               capture_output=True, text=True, check=True)
+        return json.loads(child.stdout.strip().splitlines()[-1])
+    finally:
+        if os.path.exists(output_path):
+            os.remove(output_path)
+
+
+def check_streaming_memory(corpus_dir, inputs=DEFAULT_INPUTS, budget_mb=DEFAULT_BUDGET_MB, growth=DEFAULT_GROWTH):
+    """Return a report of the N and 4N merges with a list of ``failures`` (empty when the check passes)"""
+    directory = os.path.join(corpus_dir, 'memory')
+    paths = generate_inputs(directory, inputs * 4)
+    runs = {}
+    for count in (inputs, inputs * 4):
+        runs[count] = measure_merge(paths[:count], os.path.join(directory, f'merged_{count}.pdf'))
+
+    failures = []
+    for count, run in runs.items():
+        if run['engine'] != 'fitz-streaming':
+            failures.append(f"{count} inputs were merged by {run['engine']}, not fitz-streaming")
+        if run['peak_kb'] > budget_mb * 1024:
+            failures.append(f"{count} inputs peaked at {run['peak_kb'] / 1024:.1f} MB, over the {budget_mb} MB budget")
+    small, large = runs[inputs]['peak_kb'], runs[inputs * 4]['peak_kb']
+    if large > small * (1 + growth):
+        failures.append(f'peak RSS grew from {small / 1024:.1f} MB ({inputs} inputs) '
+                        f'to {large / 1024:.1f} MB ({inputs * 4} inputs)')
+    return {
+        'budget_mb': budget_mb,
+        'growth_allowed': growth,
+        'runs': {str(count): run for count, run in runs.items()},
+        'failures': failures,
+    }
+
+
+def print_memory_check(report):
+    for count, run in report['runs'].items():
+        print(f"{'streaming merge of ' + count:<28} peak {run['peak_kb'] / 1024:8.1f} MB"
+              f"  (budget {report['budget_mb']} MB)", file=sys.stderr)
+    for failure in report['failures']:
+        print(f'MEMORY {failure}', file=sys.stderr)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Check that streaming merges stay within a fixed memory budget.')
+    parser.add_argument('--inputs', type=int, default=DEFAULT_INPUTS, help='Smaller merge size; the larger is 4x')
+    parser.add_argument('--budget-mb', type=float, default=DEFAULT_BUDGET_MB, help='Largest allowed peak RSS')
+    parser.add_argument('--growth', type=float, default=DEFAULT_GROWTH,
+                        help='Allowed relative increase in peak RSS from the smaller merge to the larger')
+    parser.add_argument('--corpus-dir', default='/tmp/pdf-merger-bench-corpus')
+    args = parser.parse_args(argv)
+
+    report = check_streaming_memory(args.corpus_dir, args.inputs, args.budget_mb, args.growth)
+    print_memory_check(report)
+    print(json.dumps(report, indent=2, sort_keys=True))
+    return 1 if report['failures'] else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
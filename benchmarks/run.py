@@ -0,0 +1,173 @@
+"""Run the benchmark suite and optionally compare against a stored baseline.
+
+    python -m benchmarks.run --output results.json
+    python -m benchmarks.run --baseline results.json --threshold 0.2
+
+Every case runs in a fresh process so its peak RSS is not inflated by the
+cases before it. Results record wall time (median and min over
+``--repeat`` runs), peak RSS and bytes written. With ``--baseline`` the
+command exits with status 1 if any case got slower or bigger by more than
+``--threshold``. The report also includes a cold-start section: app import
+time, the first template-only request and per-library import times, and
+the streaming merge memory check from ``benchmarks.memory``, which fails
+the run when a merge goes over its budget.
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import platform
+import resource
+import statistics
+import sys
+import time
+
+from benchmarks.cases import CASES, load_app
+from benchmarks.corpus import generate_corpus
+from benchmarks.importtime import measure_import_times, print_import_times
+from benchmarks.memory import check_streaming_memory, print_memory_check
+
+DEFAULT_CORPUS_DIR = '/tmp/pdf-merger-bench-corpus'
+COMPARED_METRICS = ('wall_time_median', 'peak_rss_kb')
+
+
+def _peak_rss_kb():
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def _run_case(name, scale, corpus_dir, repeat, conn):
+    try:
+        app_module = load_app()
+        corpus = generate_corpus(corpus_dir, scale)
+        setup, run = CASES[name](app_module, corpus)
+        rss_before = _peak_rss_kb()
+        wall_times = []
+        bytes_written = 0
+        for _ in range(repeat):
+            state = setup() if setup else None
+            start = time.perf_counter()
+            bytes_written = run(state)
+            wall_times.append(time.perf_counter() - start)
+        conn.send({
+            'wall_time_median': statistics.median(wall_times),
+            'wall_time_min': min(wall_times),
+            'repeat': repeat,
+            'peak_rss_kb': _peak_rss_kb(),
+            'baseline_rss_kb': rss_before,
+            'bytes_written': bytes_written
+        })
+    except Exception as e:
+        conn.send({'error': f'{type(e).__name__}: {e}'})
+    finally:
+        conn.close()
+        # multiprocessing joins a process's children before it exits; idle worker
+        # pools the app started (e.g. for /split) would never return
+        for child in multiprocessing.active_children():
+            child.terminate()
+
+
+def run_cases(names, scale, corpus_dir, repeat):
+    ctx = multiprocessing.get_context('spawn')
+    results = {}
+    for name in names:
+        parent_conn, child_conn = ctx.Pipe(duplex=False)
+        process = ctx.Process(target=_run_case, args=(name, scale, corpus_dir, repeat, child_conn))
+        process.start()
+        child_conn.close()
+        try:
+            results[name] = parent_conn.recv()
+        except EOFError:
+            results[name] = {'error': f'benchmark process exited with code {process.exitcode}'}
+        process.join()
+        _print_result(name, results[name])
+    return results
+
+
+def _print_result(name, result):
+    if 'error' in result:
+        print(f'{name:<28} ERROR {result["error"]}', file=sys.stderr)
+        return
+    print(f'{name:<28} {result["wall_time_median"] * 1000:10.1f} ms'
+          f'  peak {result["peak_rss_kb"] / 1024:8.1f} MB'
+          f'  written {result["bytes_written"] / 1024:10.1f} KB', file=sys.stderr)
+
+
+def compare(results, baseline, threshold):
+    """Return a list of human-readable regressions against ``baseline``"""
+    regressions = []
+    for name, result in results.items():
+        previous = baseline.get('results', {}).get(name)
+        if not previous or 'error' in result or 'error' in previous:
+            continue
+        for metric in COMPARED_METRICS:
+            if previous[metric] and result[metric] > previous[metric] * (1 + threshold):
+                change = result[metric] / previous[metric] - 1
+                regressions.append(f'{name}: {metric} {previous[metric]:.4g} -> {result[metric]:.4g} (+{change:.0%})')
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the PDF merge and edit paths.')
+    parser.add_argument('--scale', choices=('small', 'full'), default='small')
+    parser.add_argument('--cases', nargs='*', choices=sorted(CASES), help='Cases to run (default: all)')
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--corpus-dir', default=DEFAULT_CORPUS_DIR)
+    parser.add_argument('--output', help='Write JSON results to this file')
+    parser.add_argument('--baseline', help='Compare against a previous JSON results file')
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help='Allowed relative increase before a metric counts as a regression')
+    parser.add_argument('--skip-import-time', action='store_true', help='Leave out the cold-start report')
+    parser.add_argument('--skip-memory-check', action='store_true', help='Leave out the streaming merge memory check')
+    args = parser.parse_args(argv)
+
+    # Build the corpus once up front so no case pays for it, in a child process:
+    # cases are forked from this one and start with its peak RSS
+    builder = multiprocessing.get_context('spawn').Process(target=generate_corpus, args=(args.corpus_dir, args.scale))
+    builder.start()
+    builder.join()
+    if builder.exitcode:
+        parser.error(f'building the corpus failed with exit code {builder.exitcode}')
+
+    import fitz
+    import PyPDF2
+    report = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+            'scale': args.scale,
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'pymupdf': fitz.VersionBind,
+            'pypdf2': PyPDF2.__version__,
+        },
+        'results': run_cases(args.cases or list(CASES), args.scale, args.corpus_dir, args.repeat),
+    }
+    if not args.skip_import_time:
+        report['import_time'] = measure_import_times(args.repeat)
+        print_import_times(report['import_time'])
+    if not args.skip_memory_check:
+        report['memory_check'] = check_streaming_memory(args.corpus_dir)
+        print_memory_check(report['memory_check'])
+
+    output = json.dumps(report, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
+
+    failed = any('error' in result for result in report['results'].values())
+    failed = failed or bool(report.get('memory_check', {}).get('failures'))
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report['results'], json.load(f), args.threshold)
+        for regression in regressions:
+            print(f'REGRESSION {regression}', file=sys.stderr)
+        failed = failed or bool(regressions)
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,155 @@
+// Resumable chunked uploads for the Vercel free plan (4.5MB request limit).
+// Chunks are sent several at a time and in any order; the server writes each
+// one at its offset and finalizes the file once every chunk has arrived.
+const CHUNK_SIZE = 3.5 * 1024 * 1024; // 3.5MB chunks (safely under 4.5MB)
+const UPLOAD_CONCURRENCY = 3;
+const CHUNK_RETRIES = 3;
+const HASH_MAX_BYTES = 64 * 1024 * 1024; // Larger files are sent without a content check
+
+function uploadIdFor(file, slot) {
+  // Reuse the same ID for the same file so a retried upload resumes
+  const key = `upload:${slot}:${file.name}:${file.size}:${file.lastModified}`;
+  let fileId = sessionStorage.getItem(key);
+  if (!fileId) {
+    fileId = `${Date.now()}_${slot}_${Math.random().toString(36).substr(2, 9)}`;
+    sessionStorage.setItem(key, fileId);
+  }
+  return fileId;
+}
+
+async function fetchUploadStatus(file, fileId) {
+  try {
+    const response = await fetch('/upload-status/' + encodeURIComponent(fileId) +
+                                  '?filename=' + encodeURIComponent(file.name));
+    if (response.ok) {
+      return await response.json();
+    }
+  } catch (error) {
+    console.warn('Could not fetch upload status:', error);
+  }
+  return null;
+}
+
+async function contentDigest(file) {
+  // SHA-256 of the file, or null where Web Crypto is unavailable (plain HTTP)
+  if (!window.crypto || !crypto.subtle || file.size > HASH_MAX_BYTES) {
+    return null;
+  }
+  const digest = await crypto.subtle.digest('SHA-256', await file.arrayBuffer());
+  return Array.from(new Uint8Array(digest), byte => byte.toString(16).padStart(2, '0')).join('');
+}
+
+async function checkExistingUpload(file, fileId) {
+  // Ask the server whether it already stores this content, so it isn't sent again
+  try {
+    const sha256 = await contentDigest(file);
+    if (!sha256) {
+      return false;
+    }
+    const formData = new FormData();
+    formData.append('fileId', fileId);
+    formData.append('filename', file.name);
+    formData.append('size', file.size);
+    formData.append('sha256', sha256);
+    const response = await fetch('/upload-check', {
+      method: 'POST',
+      body: formData
+    });
+    if (response.ok) {
+      return (await response.json()).complete;
+    }
+  } catch (error) {
+    console.warn('Could not check for an existing upload:', error);
+  }
+  return false;
+}
+
+async function sendChunk(file, fileId, chunkNumber, totalChunks) {
+  const start = chunkNumber * CHUNK_SIZE;
+  const chunk = file.slice(start, Math.min(start + CHUNK_SIZE, file.size));
+
+  for (let attempt = 1; ; attempt++) {
+    const formData = new FormData();
+    formData.append('chunk', chunk);
+    formData.append('chunkNumber', chunkNumber);
+    formData.append('totalChunks', totalChunks);
+    formData.append('chunkSize', CHUNK_SIZE);
+    formData.append('totalSize', file.size);
+    formData.append('fileId', fileId);
+    formData.append('filename', file.name);
+
+    try {
+      const response = await fetch('/upload-chunk', {
+        method: 'POST',
+        body: formData
+      });
+
+      if (!response.ok) {
+        throw new Error(`Chunk upload failed: ${response.statusText}`);
+      }
+
+      return await response.json();
+    } catch (error) {
+      if (attempt >= CHUNK_RETRIES) {
+        throw error;
+      }
+      await new Promise(resolve => setTimeout(resolve, 500 * attempt));
+    }
+  }
+}
+
+async function uploadFileInChunks(file, fileId, progressCallback) {
+  const totalChunks = Math.max(1, Math.ceil(file.size / CHUNK_SIZE));
+
+  // Skip chunks the server already has from an earlier attempt
+  const received = new Set();
+  const status = await fetchUploadStatus(file, fileId);
+  if (status && status.complete) {
+    progressCallback(100, file.name);
+    return fileId;
+  }
+  if (status && status.totalChunks === totalChunks && status.chunkSize === CHUNK_SIZE) {
+    status.receivedChunks.forEach(chunkNumber => received.add(chunkNumber));
+  }
+  if (received.size === 0 && await checkExistingUpload(file, fileId)) {
+    progressCallback(100, file.name);
+    return fileId;
+  }
+
+  const pending = [];
+  for (let chunkNumber = 0; chunkNumber < totalChunks; chunkNumber++) {
+    if (!received.has(chunkNumber)) {
+      pending.push(chunkNumber);
+    }
+  }
+  if (pending.length === 0) {
+    // Everything arrived but finalization was interrupted; resend one chunk to finish it
+    pending.push(totalChunks - 1);
+    received.delete(totalChunks - 1);
+  }
+
+  let doneChunks = received.size;
+  let complete = false;
+  progressCallback((doneChunks / totalChunks) * 100, file.name);
+
+  async function worker() {
+    while (pending.length > 0) {
+      const chunkNumber = pending.shift();
+      const result = await sendChunk(file, fileId, chunkNumber, totalChunks);
+      doneChunks++;
+      complete = complete || result.complete;
+      progressCallback((doneChunks / totalChunks) * 100, file.name);
+    }
+  }
+
+  const workers = [];
+  for (let i = 0; i < Math.min(UPLOAD_CONCURRENCY, pending.length); i++) {
+    workers.push(worker());
+  }
+  await Promise.all(workers);
+
+  if (!complete) {
+    throw new Error(`Upload of ${file.name} did not complete`);
+  }
+  return fileId;
+}
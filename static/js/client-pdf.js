@@ -0,0 +1,63 @@
+// Small merges and page edits run in the browser with pdf-lib, inside a Web
+// Worker (pdf-worker.js) so the page stays responsive. runInBrowser() resolves
+// to the output bytes, or to null when the job should use the server routes:
+// no Worker support, pdf-lib could not be loaded, a file could not be parsed,
+// or the output would have more pages than the configured limit.
+let pdfWorker = null;
+let pdfWorkerJobs = 0;
+const pdfWorkerCallbacks = new Map();
+
+function startPdfWorker(settings) {
+  pdfWorker = new Worker(settings.workerUrl);
+  pdfWorker.onmessage = function(event) {
+    const resolve = pdfWorkerCallbacks.get(event.data.id);
+    pdfWorkerCallbacks.delete(event.data.id);
+    if (event.data.fallback) {
+      console.info('Using the server instead of the browser:', event.data.fallback);
+    }
+    resolve(event.data.bytes || null);
+  };
+  pdfWorker.onerror = function(event) {
+    console.info('PDF worker failed, using the server instead:', event.message);
+    pdfWorkerCallbacks.forEach(resolve => resolve(null));
+    pdfWorkerCallbacks.clear();
+    pdfWorker = null;
+  };
+}
+
+function runInBrowser(settings, job, transfer) {
+  if (typeof Worker === 'undefined') {
+    return Promise.resolve(null);
+  }
+  if (!pdfWorker) {
+    startPdfWorker(settings);
+  }
+  const id = ++pdfWorkerJobs;
+  return new Promise(resolve => {
+    pdfWorkerCallbacks.set(id, resolve);
+    pdfWorker.postMessage(Object.assign({ id: id, libUrls: settings.libUrls, maxPages: settings.maxPages }, job),
+                          transfer || []);
+  });
+}
+
+// Images are converted to pages by the server only
+function isImageFile(file) {
+  return (file.type || '').startsWith('image/') || /\.(jpe?g|png|tiff?)$/i.test(file.name);
+}
+
+function browserCanHandle(settings, files, extraBytes) {
+  const totalBytes = files.reduce((sum, file) => sum + file.size, extraBytes || 0);
+  return settings.maxBytes > 0 && totalBytes <= settings.maxBytes && !files.some(isImageFile);
+}
+
+function saveBytes(bytes, filename) {
+  const url = URL.createObjectURL(new Blob([bytes], { type: 'application/pdf' }));
+  const link = document.createElement('a');
+  link.href = url;
+  link.download = filename;
+  document.body.appendChild(link);
+  link.click();
+  link.remove();
+  // Give the browser time to start the download before the URL is revoked
+  setTimeout(() => URL.revokeObjectURL(url), 60 * 1000);
+}
@@ -0,0 +1,67 @@
+// Background merge/edit jobs (see the /jobs/* routes). Progress is streamed
+// with Server-Sent Events, falling back to polling if the stream drops.
+const JOB_SUBMIT_RETRIES = 5;
+
+async function submitJob(url, formData) {
+  for (let attempt = 1; ; attempt++) {
+    const response = await fetch(url, {
+      method: 'POST',
+      body: formData
+    });
+
+    if (response.status === 503 && attempt < JOB_SUBMIT_RETRIES) {
+      // Server is at capacity; wait as long as it asks before trying again
+      const retryAfter = parseInt(response.headers.get('Retry-After') || '5', 10);
+      await new Promise(resolve => setTimeout(resolve, retryAfter * 1000));
+      continue;
+    }
+
+    const result = await response.json();
+    if (!response.ok || !result.job_id) {
+      throw new Error(result.error || 'Server error occurred');
+    }
+    return result.job_id;
+  }
+}
+
+function waitForJob(jobId, onProgress) {
+  return new Promise((resolve, reject) => {
+    const events = new EventSource('/jobs/' + encodeURIComponent(jobId) + '/events');
+
+    events.onmessage = function(event) {
+      const status = JSON.parse(event.data);
+      onProgress(status);
+      if (status.state === 'done') {
+        events.close();
+        resolve(status.result);
+      } else if (status.state === 'failed') {
+        events.close();
+        reject(new Error(status.error || 'Job failed'));
+      }
+    };
+
+    events.onerror = function() {
+      events.close();
+      pollJob(jobId, onProgress).then(resolve, reject);
+    };
+  });
+}
+
+async function pollJob(jobId, onProgress) {
+  while (true) {
+    const response = await fetch('/jobs/' + encodeURIComponent(jobId));
+    const status = await response.json();
+    if (!response.ok) {
+      throw new Error(status.error || 'Job not found');
+    }
+
+    onProgress(status);
+    if (status.state === 'done') {
+      return status.result;
+    }
+    if (status.state === 'failed') {
+      throw new Error(status.error || 'Job failed');
+    }
+    await new Promise(resolve => setTimeout(resolve, 500));
+  }
+}
@@ -1,2 +1,3 @@
-// Placeholder for PDF-lib CDN - will be loaded from CDN in HTML
-// This file is just to ensure the static/js directory exists
+// Placeholder for pdf-lib (https://pdf-lib.js.org). pdf-worker.js tries this file
+// first and then loads pdf-lib from CLIENT_PDF_LIB_URL (a CDN by default).
+// Replace it with pdf-lib's dist/pdf-lib.min.js to serve the library from here.
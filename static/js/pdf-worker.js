@@ -0,0 +1,105 @@
+// Merges and page edits with pdf-lib, off the main thread (see client-pdf.js).
+// Replies { id, bytes } with the finished PDF, or { id, fallback } with the
+// reason the server should do the job instead.
+let PDFLib = null;
+
+function loadLibrary(urls) {
+  for (const url of urls) {
+    try {
+      importScripts(url);
+    } catch (e) {
+      continue;
+    }
+    // The bundled file may be a placeholder that defines nothing
+    if (self.PDFLib && self.PDFLib.PDFDocument) {
+      return self.PDFLib;
+    }
+  }
+  return null;
+}
+
+class PageLimitError extends Error {}
+
+function loadDocument(buffer) {
+  // Encrypted and unparseable files throw here and go to the server instead
+  return PDFLib.PDFDocument.load(buffer, { updateMetadata: false });
+}
+
+async function copyInto(output, doc, indices, maxPages) {
+  if (output.getPageCount() + indices.length > maxPages) {
+    throw new PageLimitError(`more than ${maxPages} pages`);
+  }
+  const pages = await output.copyPages(doc, indices);
+  pages.forEach(page => output.addPage(page));
+}
+
+// "1-3, 5, 8-" as 0-based page indices, like parse_page_ranges in pdf_core.py
+function rangeIndices(spec, pageCount) {
+  const indices = [];
+  for (const item of spec.split(/[,;\s]+/)) {
+    if (!item) {
+      continue;
+    }
+    const match = /^(\d*)(-?)(\d*)$/.exec(item);
+    if (!match) {
+      throw new Error(`invalid page range ${item}`);
+    }
+    const first = match[1] ? parseInt(match[1], 10) : 1;
+    const last = match[2] ? (match[3] ? parseInt(match[3], 10) : pageCount) : first;
+    if (!(first >= 1 && first <= last && last <= pageCount)) {
+      throw new Error(`page range ${item} out of bounds`);
+    }
+    for (let index = first - 1; index < last; index++) {
+      indices.push(index);
+    }
+  }
+  return indices;
+}
+
+// sources: distinct files; order: index into sources for each merge slot
+async function merge({ sources, order, maxPages }) {
+  const docs = [];
+  for (const buffer of sources) {
+    docs.push(await loadDocument(buffer));
+  }
+  const output = await PDFLib.PDFDocument.create();
+  for (const index of order) {
+    await copyInto(output, docs[index], docs[index].getPageIndices(), maxPages);
+  }
+  return output.save();
+}
+
+// steps: { pages: [0-based indices of source] } or { insert: index into inserts, ranges: optional "2-4" }
+async function edit({ source, inserts, steps, maxPages }) {
+  const sourceDoc = await loadDocument(source);
+  const insertDocs = [];
+  for (const buffer of inserts) {
+    insertDocs.push(await loadDocument(buffer));
+  }
+  const output = await PDFLib.PDFDocument.create();
+  for (const step of steps) {
+    if (step.pages) {
+      await copyInto(output, sourceDoc, step.pages, maxPages);
+    } else {
+      const doc = insertDocs[step.insert];
+      const indices = step.ranges ? rangeIndices(step.ranges, doc.getPageCount()) : doc.getPageIndices();
+      await copyInto(output, doc, indices, maxPages);
+    }
+  }
+  return output.save();
+}
+
+self.onmessage = async function(event) {
+  const job = event.data;
+  try {
+    PDFLib = PDFLib || loadLibrary(job.libUrls);
+    if (!PDFLib) {
+      self.postMessage({ id: job.id, fallback: 'pdf-lib could not be loaded' });
+      return;
+    }
+    const bytes = job.op === 'merge' ? await merge(job) : await edit(job);
+    self.postMessage({ id: job.id, bytes: bytes }, [bytes.buffer]);
+  } catch (e) {
+    self.postMessage({ id: job.id, fallback: e.message || String(e) });
+  }
+};